@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_discord import MockDiscord
+
+DISCORD_DL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "discord_dl")
+
+
+def run_once(mock: MockDiscord, downloader_args: list, keep: str = None, guild: bool = False) -> dict:
+    path = keep or tempfile.mkdtemp(prefix="discord_dl_benchmark_")
+    os.makedirs(path, exist_ok=True)
+    before = dict(mock.stats)
+    command = [
+        sys.executable,
+        DISCORD_DL,
+        "--token",
+        "benchmark",
+        "--api-url",
+        mock.api_url,
+        "--path",
+        path,
+        "--quiet",
+        *downloader_args,
+        *(["--server", mock.guild["id"]] if guild else mock.channels),
+    ]
+    start = time.perf_counter()
+    process = subprocess.Popen(command)
+    # wait4 gives the resource usage of this child only
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if not keep:
+        shutil.rmtree(path, ignore_errors=True)
+
+    stats = {key: mock.stats[key] - before[key] for key in mock.stats}
+    return {
+        "exit_status": os.waitstatus_to_exitcode(status),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(stats["messages"] / elapsed, 1),
+        "files_per_second": round(stats["files"] / elapsed, 1),
+        "megabytes_per_second": round(stats["bytes"] / 2**20 / elapsed, 2),
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_megabytes": round(rusage.ru_maxrss / 2**10, 1),
+        **stats,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark discord_dl against a local mock of the Discord API and CDN. "
+        "Arguments after -- are passed to discord_dl"
+    )
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--messages", type=int, default=10000, help="Messages per channel")
+    parser.add_argument("--attachment-ratio", type=float, default=0.25)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--rate-limit", type=int, default=50, help="Requests per second per route, 0 disables")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.0)
+    parser.add_argument("--drop-chance", type=float, default=0.0)
+    parser.add_argument("--threads", type=int, default=0, help="Archived threads per channel")
+    parser.add_argument("--guild", action="store_true", help="Download the whole server instead of listing the channels")
+    parser.add_argument("--connection-bandwidth", type=int, default=0, help="Bytes per second per attachment response, 0 disables")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--keep", type=str, default=None, help="Download into this path and keep it between runs")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to this file")
+    args, downloader_args = parser.parse_known_args()
+    if downloader_args[:1] == ["--"]:
+        downloader_args = downloader_args[1:]
+
+    mock = MockDiscord(
+        channels=args.channels,
+        messages=args.messages,
+        attachment_ratio=args.attachment_ratio,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        rate_limit_chance=args.rate_limit_chance,
+        drop_chance=args.drop_chance,
+        connection_bandwidth=args.connection_bandwidth,
+        threads=args.threads,
+    ).start()
+    print(
+        f"{args.channels} channel(s), {args.messages} messages each, "
+        f"{len(mock.files)} attachments, {sum(mock.files.values()) / 2**20:.1f} MB"
+    )
+
+    results = []
+    try:
+        for run in range(args.runs):
+            result = run_once(mock, downloader_args, args.keep, args.guild)
+            results.append(result)
+            print(
+                f"run {run + 1}: {result['seconds']}s | {result['messages_per_second']} messages/s | "
+                f"{result['files_per_second']} files/s | {result['megabytes_per_second']} MB/s | "
+                f"peak rss {result['peak_rss_megabytes']} MB | {result['requests']} requests | "
+                f"{result['rate_limited']} 429s | exit {result['exit_status']}"
+            )
+    finally:
+        mock.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"arguments": vars(args), "downloader_args": downloader_args, "runs": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DISCORD_EPOCH = 1420070400000
+
+# (weight, min size, max size) of the generated attachments
+DEFAULT_FILE_SIZES = [
+    (80, 2**10, 64 * 2**10),
+    (18, 64 * 2**10, 2**20),
+    (2, 2**20, 8 * 2**20),
+]
+
+
+class MockDiscord:
+    def __init__(
+        self,
+        channels: int = 1,
+        messages: int = 10000,
+        attachment_ratio: float = 0.25,
+        file_sizes: list = None,
+        latency: float = 0.0,
+        rate_limit: int = 50,
+        rate_limit_chance: float = 0.0,
+        drop_chance: float = 0.0,
+        connection_bandwidth: int = 0,
+        threads: int = 0,
+        url_ttl: float = 0,
+        error_chance: float = 0.0,
+        api_error_chance: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        # latency is in seconds and added to every request, rate_limit is the number of
+        # requests per second allowed for each route and channel before answering 429,
+        # connection_bandwidth caps every attachment response at this many bytes per second,
+        # threads is the number of archived threads per channel, each channel also gets one
+        # active thread when it is set. url_ttl makes attachment urls expire this many seconds
+        # after the message was fetched, error_chance answers attachments with a 503 and
+        # api_error_chance answers api requests with a 502
+        self.latency = latency
+        self.connection_bandwidth = connection_bandwidth
+        self.rate_limit = rate_limit
+        self.rate_limit_chance = rate_limit_chance
+        self.drop_chance = drop_chance
+        self.url_ttl = url_ttl
+        self.error_chance = error_chance
+        self.api_error_chance = api_error_chance
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.md5s = {}
+        self.stats = {
+            "requests": 0,
+            "rate_limited": 0,
+            "dropped": 0,
+            "expired": 0,
+            "errors": 0,
+            "messages": 0,
+            "files": 0,
+            "bytes": 0,
+        }
+        self.server = None
+        self.guild = {"id": "100000000000000001", "name": "Benchmark", "owner_id": "1"}
+        self.users = [
+            {"id": str(200000000000000000 + i), "username": f"user{i}"} for i in range(8)
+        ]
+        self.channels = {}
+        self.threads = {}
+        self.messages = {}
+        self.files = {}
+        self.file_sizes = file_sizes or DEFAULT_FILE_SIZES
+        self.attachment_ratio = attachment_ratio
+        self.start_ms = int(datetime(2021, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+        for c in range(channels):
+            channel_id = str(300000000000000000 + c)
+            self.channels[channel_id] = {
+                "id": channel_id,
+                "type": 0,
+                "guild_id": self.guild["id"],
+                "name": f"channel-{c}",
+                "topic": None,
+                "position": c,
+            }
+            self.messages[channel_id] = self._generate_messages(channel_id, f"{c}", messages, c)
+            for t in range(threads + 1 if threads else 0):
+                thread_id = str(400000000000000000 + c * 1000 + t)
+                archive_ms = self.start_ms + t * 3600000
+                self.threads[thread_id] = {
+                    "id": thread_id,
+                    "type": 11,
+                    "guild_id": self.guild["id"],
+                    "parent_id": channel_id,
+                    "name": f"thread-{c}-{t}",
+                    "thread_metadata": {
+                        # the last thread of every channel is active
+                        "archived": t < threads,
+                        "archive_timestamp": datetime.fromtimestamp(
+                            archive_ms / 1000, timezone.utc
+                        ).isoformat(),
+                    },
+                }
+                # ids are spaced by two so attachment ids (message id + 1) never collide
+                self.messages[thread_id] = self._generate_messages(
+                    thread_id, f"{c}_{t}", max(1, messages // 10), 100000 + 2 * (c * 1000 + t)
+                )
+
+    def _generate_messages(self, channel_id: str, name: str, count: int, low_bits: int) -> list:
+        channel_messages = []
+        for i in range(count):
+            # one message every 10 minutes
+            ms = self.start_ms + i * 600000
+            message_id = ((ms - DISCORD_EPOCH) << 22) + low_bits
+            attachments = []
+            if self.random.random() < self.attachment_ratio:
+                attachment_id = str(message_id + 1)
+                low, high = self._pick_size(self.file_sizes)
+                size = self.random.randint(low, high)
+                filename = f"file_{name}_{i}.bin"
+                self.files[attachment_id] = size
+                attachments.append(
+                    {
+                        "id": attachment_id,
+                        "filename": filename,
+                        "size": size,
+                        "content_type": "application/octet-stream",
+                        "url": f"/attachments/{channel_id}/{attachment_id}/{filename}",
+                    }
+                )
+            channel_messages.append(
+                {
+                    "id": str(message_id),
+                    "channel_id": channel_id,
+                    "timestamp": datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat(),
+                    "author": self.users[i % len(self.users)],
+                    "content": f"message {i}",
+                    "attachments": attachments,
+                }
+            )
+        # newest first, the same order the api returns
+        channel_messages.reverse()
+        return channel_messages
+
+    def _pick_size(self, file_sizes: list) -> tuple:
+        pick = self.random.uniform(0, sum(weight for weight, _, _ in file_sizes))
+        for weight, low, high in file_sizes:
+            pick -= weight
+            if pick <= 0:
+                return low, high
+        return file_sizes[-1][1:]
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}/api/v9"
+
+    def file_content(self, attachment_id: str) -> bytes:
+        size = self.files[attachment_id]
+        block = hashlib.sha256(attachment_id.encode()).digest() * 128
+        return (block * (size // len(block) + 1))[:size]
+
+    def file_md5(self, attachment_id: str) -> str:
+        with self.lock:
+            md5 = self.md5s.get(attachment_id)
+        if md5 is None:
+            md5 = hashlib.md5(self.file_content(attachment_id)).hexdigest()
+            with self.lock:
+                self.md5s[attachment_id] = md5
+        return md5
+
+    def count(self, key: str, value: int = 1) -> None:
+        with self.lock:
+            self.stats[key] += value
+
+    def take_rate_limit(self, route: str):
+        # returns None when the request may go through, otherwise the seconds to wait
+        if self.random.random() < self.rate_limit_chance:
+            return 0.1
+        if not self.rate_limit:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(route)
+            if window is None or window[1] <= now:
+                window = self.windows[route] = [self.rate_limit, now + 1.0]
+            if window[0] <= 0:
+                return window[1] - now
+            window[0] -= 1
+        return None
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "MockDiscord":
+        mock = self
+
+        class Handler(MockDiscordHandler):
+            pass
+
+        Handler.mock = mock
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MockDiscordHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without this every response waits on
+    # a delayed ack when the connection is kept alive
+    disable_nagle_algorithm = True
+    mock = None
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, body, status: int = 200, headers: dict = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        mock = self.mock
+        mock.count("requests")
+        if mock.latency:
+            time.sleep(mock.latency)
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.startswith("/attachments/"):
+            return self.send_attachment(url.path, query)
+        if url.path.startswith("/api/v9/"):
+            path = url.path[len("/api/v9") :]
+            if self.headers.get("Authorization") is None:
+                return self.send_json({"message": "401: Unauthorized", "code": 0}, 401)
+            if mock.api_error_chance and mock.random.random() < mock.api_error_chance:
+                mock.count("errors")
+                return self.send_error_status(502, "Bad Gateway")
+            route = re.sub(r"\?.*", "", path)
+            retry_after = mock.take_rate_limit(route)
+            if retry_after is not None:
+                mock.count("rate_limited")
+                return self.send_json(
+                    {
+                        "message": "You are being rate limited.",
+                        "retry_after": round(retry_after, 3),
+                        "global": False,
+                    },
+                    429,
+                    {
+                        "X-RateLimit-Bucket": route,
+                        "X-RateLimit-Remaining": "0",
+                        "X-RateLimit-Reset-After": str(round(retry_after, 3)),
+                    },
+                )
+            return self.send_api(path, query)
+        self.send_json({"message": "404: Not Found", "code": 0}, 404)
+
+    def do_HEAD(self) -> None:
+        mock = self.mock
+        mock.count("requests")
+        if mock.latency:
+            time.sleep(mock.latency)
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.startswith("/attachments/"):
+            return self.send_attachment(url.path, query, head=True)
+        self.send_response(405)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def rate_limit_headers(self, route: str) -> dict:
+        window = self.mock.windows.get(route)
+        if window is None:
+            return {}
+        return {
+            "X-RateLimit-Bucket": route,
+            "X-RateLimit-Limit": str(self.mock.rate_limit),
+            "X-RateLimit-Remaining": str(max(0, window[0])),
+            "X-RateLimit-Reset-After": str(round(max(0, window[1] - time.monotonic()), 3)),
+        }
+
+    def send_api(self, path: str, query: dict) -> None:
+        mock = self.mock
+        headers = self.rate_limit_headers(path)
+        if path == "/users/@me":
+            return self.send_json({"id": "1", "username": "benchmark"}, headers=headers)
+        match = re.fullmatch(r"/guilds/(\d+)", path)
+        if match and match.group(1) == mock.guild["id"]:
+            return self.send_json(mock.guild, headers=headers)
+        match = re.fullmatch(r"/guilds/(\d+)/channels", path)
+        if match and match.group(1) == mock.guild["id"]:
+            return self.send_json(list(mock.channels.values()), headers=headers)
+        match = re.fullmatch(r"/guilds/(\d+)/messages/search", path)
+        if match and match.group(1) == mock.guild["id"]:
+            results = self.search_messages(query)
+            mock.count("messages", len(results["messages"]))
+            return self.send_json(results, headers=headers)
+        match = re.fullmatch(r"/guilds/(\d+)/threads/active", path)
+        if match and match.group(1) == mock.guild["id"]:
+            active = [
+                thread
+                for thread in mock.threads.values()
+                if not thread["thread_metadata"]["archived"]
+            ]
+            return self.send_json({"threads": active, "members": []}, headers=headers)
+        match = re.fullmatch(r"/channels/(\d+)/threads/archived/(public|private)", path)
+        if match and match.group(1) in mock.channels:
+            if match.group(2) == "private":
+                return self.send_json({"message": "Missing Permissions", "code": 50013}, 403)
+            return self.send_json(self.select_threads(match.group(1), query), headers=headers)
+        match = re.fullmatch(r"/channels/(\d+)", path)
+        if match and match.group(1) in mock.channels:
+            return self.send_json(mock.channels[match.group(1)], headers=headers)
+        if match and match.group(1) in mock.threads:
+            return self.send_json(mock.threads[match.group(1)], headers=headers)
+        match = re.fullmatch(r"/channels/(\d+)/messages", path)
+        if match and match.group(1) in mock.messages:
+            messages = self.select_messages(mock.messages[match.group(1)], query)
+            mock.count("messages", len(messages))
+            return self.send_json(
+                [self.with_urls(message) for message in messages], headers=headers
+            )
+        self.send_json({"message": "404: Not Found", "code": 0}, 404)
+
+    def select_threads(self, channel_id: str, query: dict) -> dict:
+        # newest archived first, before is an iso 8601 archive timestamp
+        limit = min(int(query.get("limit", 50)), 100)
+        threads = [
+            thread
+            for thread in self.mock.threads.values()
+            if thread["parent_id"] == channel_id and thread["thread_metadata"]["archived"]
+        ]
+        threads.sort(key=lambda thread: thread["thread_metadata"]["archive_timestamp"], reverse=True)
+        if "before" in query:
+            before = datetime.fromisoformat(query["before"])
+            threads = [
+                thread
+                for thread in threads
+                if datetime.fromisoformat(thread["thread_metadata"]["archive_timestamp"]) < before
+            ]
+        return {"threads": threads[:limit], "members": [], "has_more": len(threads) > limit}
+
+    def search_messages(self, query: dict) -> dict:
+        # only the parameters discord_dl uses, 25 results per page like the real search
+        messages = self.mock.messages.get(query.get("channel_id"), [])
+        if query.get("has") == "file":
+            messages = [message for message in messages if message["attachments"]]
+        if "author_id" in query:
+            messages = [message for message in messages if message["author"]["id"] == query["author_id"]]
+        if "min_id" in query:
+            messages = [message for message in messages if int(message["id"]) > int(query["min_id"])]
+        if "max_id" in query:
+            messages = [message for message in messages if int(message["id"]) < int(query["max_id"])]
+        if query.get("sort_order") == "asc":
+            messages = messages[::-1]
+        offset = int(query.get("offset", 0))
+        return {
+            "total_results": len(messages),
+            "messages": [[self.with_urls(message)] for message in messages[offset : offset + 25]],
+        }
+
+    def select_messages(self, messages: list, query: dict) -> list:
+        limit = min(int(query.get("limit", 50)), 100)
+        if "before" in query:
+            before = int(query["before"])
+            selected = [message for message in messages if int(message["id"]) < before]
+            return selected[:limit]
+        if "after" in query:
+            after = int(query["after"])
+            selected = [message for message in messages if int(message["id"]) > after]
+            return selected[-limit:]
+        if "around" in query:
+            around = query["around"]
+            for i, message in enumerate(messages):
+                if message["id"] == around:
+                    start = max(0, i - limit // 2)
+                    return messages[start : start + limit]
+            return []
+        return messages[:limit]
+
+    def with_urls(self, message: dict) -> dict:
+        if not message["attachments"]:
+            return message
+        # signed like discord's cdn urls, ex is when the url expires in hex
+        signature = f"?ex={int(time.time() + self.mock.url_ttl):x}" if self.mock.url_ttl else ""
+        attachments = [
+            {**attachment, "url": self.mock.url + attachment["url"] + signature}
+            for attachment in message["attachments"]
+        ]
+        return {**message, "attachments": attachments}
+
+    def send_error_status(self, status: int, message: str, head: bool = False) -> None:
+        if head:
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_json({"message": message, "code": 0}, status)
+
+    def send_attachment(self, path: str, query: dict, head: bool = False) -> None:
+        mock = self.mock
+        match = re.fullmatch(r"/attachments/\d+/(\d+)/[^/]+", path)
+        if match is None or match.group(1) not in mock.files:
+            return self.send_error_status(404, "404: Not Found", head)
+        attachment_id = match.group(1)
+        if mock.url_ttl and int(query.get("ex", "0"), 16) < time.time():
+            mock.count("expired")
+            return self.send_error_status(403, "This content is no longer available.", head)
+        if mock.error_chance and mock.random.random() < mock.error_chance:
+            mock.count("errors")
+            return self.send_error_status(503, "Service Unavailable", head)
+        etag = f'"{mock.file_md5(attachment_id)}"'
+        data = mock.file_content(attachment_id)
+        size = len(data)
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == etag):
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header)
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+        body = data[start : end + 1]
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if head:
+            return
+        if mock.random.random() < mock.drop_chance:
+            # send part of the body and then drop the connection
+            self.wfile.write(body[: len(body) // 2])
+            mock.count("dropped")
+            mock.count("bytes", len(body) // 2)
+            self.close_connection = True
+            return
+        if mock.connection_bandwidth:
+            # writes a tenth of a second worth of bytes at a time
+            step = max(1, mock.connection_bandwidth // 10)
+            for offset in range(0, len(body), step):
+                self.wfile.write(body[offset : offset + step])
+                time.sleep(len(body[offset : offset + step]) / mock.connection_bandwidth)
+        else:
+            self.wfile.write(body)
+        # segmented downloads request a file in several ranges, count it once
+        if start == 0:
+            mock.count("files")
+        mock.count("bytes", len(body))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the Discord API and CDN")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--attachment-ratio", type=float, default=0.25)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--rate-limit", type=int, default=50, help="Requests per second per route, 0 disables")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.0)
+    parser.add_argument("--drop-chance", type=float, default=0.0)
+    parser.add_argument("--connection-bandwidth", type=int, default=0, help="Bytes per second per attachment response, 0 disables")
+    parser.add_argument("--threads", type=int, default=0, help="Archived threads per channel")
+    parser.add_argument("--url-ttl", type=float, default=0, help="Seconds until attachment urls expire, 0 disables")
+    parser.add_argument("--error-chance", type=float, default=0.0, help="Chance of answering an attachment request with a 503")
+    parser.add_argument("--api-error-chance", type=float, default=0.0, help="Chance of answering an api request with a 502")
+    args = parser.parse_args()
+
+    mock = MockDiscord(
+        channels=args.channels,
+        messages=args.messages,
+        attachment_ratio=args.attachment_ratio,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        rate_limit_chance=args.rate_limit_chance,
+        drop_chance=args.drop_chance,
+        connection_bandwidth=args.connection_bandwidth,
+        threads=args.threads,
+        url_ttl=args.url_ttl,
+        error_chance=args.error_chance,
+        api_error_chance=args.api_error_chance,
+    ).start(args.host, args.port)
+    print(f"Serving the mock Discord API at {mock.api_url}")
+    print(f"Channel ids: {' '.join(mock.channels)}")
+    print(f"Server id: {mock.guild['id']}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
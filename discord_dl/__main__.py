@@ -1,8 +1,30 @@
+import sys
+
 from arguments import get_args
+from ledger import run_processes
+from logger import set_log_level
+from service import SpoolService
+from verify import LibraryVerifier
 
 from discord_dl import DiscordDownloader
 
 if __name__ == "__main__":
     options = vars(get_args())
+    set_log_level(options["verbose"], options["quiet"])
+    if options["processes"] > 1:
+        sys.exit(run_processes(options["processes"], sys.argv[1:]))
     dd = DiscordDownloader(options)
-    dd.download()
+    try:
+        if options["serve"]:
+            SpoolService(dd, options["serve"], options, options["poll_interval"]).serve()
+        elif options["verify_files"]:
+            LibraryVerifier(dd, options["verify_processes"]).run(options["repair"])
+        else:
+            summary = dd.download()
+            # scripts and schedulers can tell an incomplete run from a finished one
+            if summary["interrupted"]:
+                sys.exit(130)
+            if summary.get("failed") or summary.get("failed_channels"):
+                sys.exit(1)
+    finally:
+        dd.close()
@@ -1,5 +1,6 @@
 import argparse
 import os
+import re
 from datetime import datetime
 
 
@@ -10,8 +11,31 @@ class ListAction(argparse.Action):
 
 class DateAction(argparse.Action):
     def __call__(self, parser, args, values, option_string=None):
-        date = datetime.strptime(values, r"%Y%m%d")
-        setattr(args, self.dest, date)
+        setattr(args, self.dest, parse_date(values))
+
+
+class SizeAction(argparse.Action):
+    def __call__(self, parser, args, values, option_string=None):
+        try:
+            setattr(args, self.dest, parse_size(values))
+        except ValueError:
+            parser.error(f"{option_string} expects a size like 500K, 20M or 2G, got {values!r}")
+
+
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, r"%Y%m%d")
+
+
+def parse_size(value) -> int:
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", str(value).strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: {value!r}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
 
 
 class LoadFileAction(argparse.Action):
@@ -29,7 +53,7 @@ class LoadFileAction(argparse.Action):
             setattr(namespace, self.dest, [])
 
 
-def get_args():
+def get_args(argv: list = None):
     parser = argparse.ArgumentParser(description="Download discord media attachments")
 
     parser.add_argument(
@@ -55,6 +79,15 @@ def get_args():
         "channel_ids", type=str, nargs="*", help="channel id or channel url", default=[]
     )
 
+    parser.add_argument(
+        "--server",
+        dest="server_ids",
+        type=str,
+        help="Download every channel and thread of this server id(s) or server url(s)",
+        action=ListAction,
+        default=[],
+    )
+
     parser.add_argument(
         "--file",
         type=str,
@@ -116,10 +149,76 @@ def get_args():
     parser.add_argument(
         "--max-retries",
         type=int,
-        help="The maximum number of times to attempt to download an attachment, Default is 0",
+        help="The maximum number of times to attempt to download an attachment, Default is 10",
         default=10,
     )
 
+    parser.add_argument(
+        "--retry-delay",
+        type=float,
+        help="The longest wait before the first retry, doubled with every retry and randomized, Default is 1",
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "--max-retry-delay",
+        type=float,
+        help="The longest wait between two retries, Default is 60",
+        default=60.0,
+    )
+
+    parser.add_argument(
+        "--concurrent-downloads",
+        type=int,
+        help="The number of attachments to download at the same time, Default is 4",
+        default=4,
+    )
+
+    parser.add_argument(
+        "--concurrent-channels",
+        type=int,
+        help="The number of channels to retrieve messages from at the same time, Default is 4",
+        default=4,
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="The number of bytes to read from the network at a time when downloading attachments, Default is 65536",
+        default=65536,
+    )
+
+    parser.add_argument(
+        "--segments",
+        type=int,
+        help="The number of connections to download a large attachment over, 1 disables segmented downloads, Default is 4",
+        default=4,
+    )
+
+    parser.add_argument(
+        "--segment-threshold",
+        type=str,
+        action=SizeAction,
+        help="Attachments at least this big are downloaded in segments, e.g. 500K, 20M or 2G, Default is 64M",
+        default=64 * 2**20,
+    )
+
+    parser.add_argument(
+        "--write-buffer",
+        type=str,
+        action=SizeAction,
+        help="How much of a download can be received ahead of what is written to disk, 0 writes in the download thread, e.g. 500K or 16M, Default is 4M",
+        default=4 * 2**20,
+    )
+
+    parser.add_argument(
+        "--fsync",
+        type=str,
+        choices=["none", "file", "block"],
+        help="When downloaded data is synced to disk: none leaves it to the operating system, file syncs every finished file, block syncs every 1 MB written, Default is none",
+        default="none",
+    )
+
     parser.add_argument(
         "--user-id",
         type=str,
@@ -167,6 +266,213 @@ def get_args():
         default=None,
     )
 
+    parser.add_argument(
+        "--content-regex",
+        type=str,
+        help="Only download attachments from messages whose text matches this regular expression",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--ext",
+        type=str,
+        help="Only download attachments with this extension(s)",
+        action=ListAction,
+        default=[],
+    )
+
+    parser.add_argument(
+        "--exclude-ext",
+        type=str,
+        help="Do not download attachments with this extension(s)",
+        action=ListAction,
+        default=[],
+    )
+
+    parser.add_argument(
+        "--content-type",
+        type=str,
+        help="Only download attachments with this content type(s), video/* matches every video type",
+        action=ListAction,
+        default=[],
+    )
+
+    parser.add_argument(
+        "--exclude-content-type",
+        type=str,
+        help="Do not download attachments with this content type(s), video/* matches every video type",
+        action=ListAction,
+        default=[],
+    )
+
+    parser.add_argument(
+        "--min-size",
+        type=str,
+        action=SizeAction,
+        help="Only download attachments at least this big, e.g. 500K, 20M or 2G",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max-size",
+        type=str,
+        action=SizeAction,
+        help="Only download attachments at most this big, e.g. 500K, 20M or 2G",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--filename-regex",
+        type=str,
+        help="Only download attachments whose filename matches this regular expression",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume partially downloaded attachments instead of starting them over",
+    )
+
+    parser.add_argument(
+        "--resume-run",
+        action="store_true",
+        help="Continue an interrupted run where it stopped, using the journal in the download path. Channels default to the ones the run was started with",
+    )
+
+    parser.add_argument(
+        "--ledger",
+        action="store_true",
+        help="Share the channels with other discord_dl processes on this machine using the same download path, each channel is downloaded by one of them and the channels of a process that stopped are taken over by the others",
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Start this many processes sharing the channels through the ledger, Default is 1",
+        default=1,
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only download attachments from messages posted since the last run, progress is stored in the download path",
+    )
+
+    parser.add_argument(
+        "--search",
+        action="store_true",
+        help="Only retrieve messages with files using the server search instead of paging through every message. Direct messages, and servers that can not be searched, are paged through",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check every attachment against the server even if the download manifest says it is already downloaded",
+    )
+
+    parser.add_argument(
+        "--metadata-ttl",
+        type=int,
+        help="How many seconds channel and server info is cached in the download path, 0 disables the cache, Default is 86400",
+        default=86400,
+    )
+
+    parser.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="Ignore cached channel and server info and look it up again",
+    )
+
+    parser.add_argument(
+        "--no-progress",
+        dest="progress",
+        action="store_false",
+        help="Do not show download progress",
+    )
+
+    parser.add_argument(
+        "--progress-files",
+        action="store_true",
+        help="Show a progress line for every active download below the overall progress",
+    )
+
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        help="Write request, file and timing metrics for the run to this file as JSON",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--metrics-prometheus",
+        type=str,
+        help="Write the run metrics to this file in the Prometheus textfile format",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--stats-interval",
+        type=int,
+        help="Log a line with the run metrics every # seconds, 0 disables it, Default is 0",
+        default=0,
+    )
+
+    parser.add_argument(
+        "--api-url",
+        type=str,
+        help="The base url of the Discord API, Default is https://discord.com/api/v9",
+        default="https://discord.com/api/v9",
+    )
+
+    parser.add_argument(
+        "--plan",
+        type=str,
+        help="Write the attachments that would be downloaded, their paths and sizes, and how they compare to what is on disk to this file without downloading anything",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--plan-format",
+        type=str,
+        choices=["ndjson", "csv"],
+        help="The format of the --plan file, Default is csv for .csv files and ndjson otherwise",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--serve",
+        type=str,
+        help="Run as a service that downloads the jobs put in this spool directory, reusing its connections and caches between jobs",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        help="How many seconds --serve waits between checks for new jobs, Default is 1",
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "--verify-files",
+        action="store_true",
+        help="Check every file in the download manifest of --path against the size and hash it was downloaded with instead of downloading",
+    )
+
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="With --verify-files, download missing, truncated, corrupted and unfinished files again",
+    )
+
+    parser.add_argument(
+        "--verify-processes",
+        type=int,
+        help="The number of processes --verify-files hashes files with, Default is the number of CPUs",
+        default=0,
+    )
+
     parser.add_argument(
         "--simulate",
         action="store_true",
@@ -174,7 +480,7 @@ def get_args():
     )
 
     # Parse the arguments passed in the command-line
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args.channel_ids += args.file if args.file is not None else []
 
     return args
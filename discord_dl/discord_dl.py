@@ -1,16 +1,118 @@
 import os
+import queue
+import threading
 import time
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
 
 import requests
-from downloader import download_file
-from filenaming import create_filepath, create_format_variables
+from discovery import GuildDiscovery
+from downloader import create_cdn_session, download_file, forget_directories
+from filenaming import (
+    create_attachment_variables,
+    create_filepath,
+    create_message_variables,
+)
+from filters import AttachmentFilter
+from journal import RunJournal
+from ledger import ChannelLedger
 from logger import logger
-from utils import convert_discord_timestamp, extract_channel_ids, mysleep
+from metrics import metrics
+from pipeline import ChannelProgress, DownloadPipeline, join_threads
+from planner import PlanWriter
+from progress import ProgressRenderer
+from ratelimit import RateLimitedSession
+from retry import (
+    CircuitBreaker,
+    CircuitBreakerAdapter,
+    RETRYABLE,
+    RetryPolicy,
+    classify_error,
+    classify_status,
+)
+from state import StateStore
+from utils import (
+    datetime_to_snowflake,
+    extract_channel_ids,
+    extract_server_ids,
+    is_server_url,
+    mysleep,
+)
+
+# the maximum number of messages the api returns per request
+MESSAGES_PER_PAGE = 100
+# the number of results the server search returns per request
+SEARCH_RESULTS_PER_PAGE = 25
+# how many times an attachment is retried before it is set aside until the end of the run
+PARK_AFTER_RETRIES = 2
 
 
 class DiscordDownloader:
     def __init__(self, options: dict) -> None:
+        # settings of the connections, which are shared by every job this downloader runs
         self.token = options.get("token", None)
+        self.discord_api = options.get("api_url", "https://discord.com/api/v9")
+        self.concurrent_downloads = options.get("concurrent_downloads", 4)
+        self.concurrent_channels = options.get("concurrent_channels", 4)
+        self.segments = options.get("segments", 4)
+        self.show_progress = options.get("progress", True)
+        self.progress_files = options.get("progress_files", False)
+
+        if self.token == None:
+            raise (f"No discord auth token passed")
+
+        self.state = None
+        # channel and server info, shared by the channel workers of a run
+        self.metadata = {}
+        self.metadata_locks = {}
+        self.metadata_lock = threading.Lock()
+        # created by download, nothing is journaled when simulating
+        self.journal = None
+        self.ledger = None
+        self.planner = None
+        # attachments that kept failing, they are retried once everything else is done
+        self.parked = []
+        self.parked_lock = threading.Lock()
+        self.parking = False
+        # target path -> [lock, jobs using it]
+        self.path_locks = {}
+        self.path_locks_lock = threading.Lock()
+        # pauses only the requests to a host that keeps failing, shared by the api and cdn
+        self.breaker = CircuitBreaker()
+        self.renderer = (
+            ProgressRenderer(per_file=self.progress_files) if self.show_progress else None
+        )
+        self.set_options(options)
+
+        headers = {
+            "Authorization": self.token,
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+        }
+        # waits on discord's rate limit headers instead of running into 429s
+        self.session = RateLimitedSession()
+        api_adapter = CircuitBreakerAdapter(
+            self.breaker, pool_maxsize=max(10, self.concurrent_channels)
+        )
+        self.session.mount("https://", api_adapter)
+        self.session.mount("http://", api_adapter)
+        self.session.headers.update(headers)
+        # every segment of a segmented download uses its own connection
+        self.cdn_session = create_cdn_session(
+            self.concurrent_downloads * max(1, self.segments),
+            headers["User-Agent"],
+            self.breaker,
+        )
+
+        # check if token is valid
+        user_me = self.get_api("/users/@me", "the current user").json()
+
+        if user_me == {"message": "401: Unauthorized", "code": 0}:
+            logger.error(f"401 Unauthorized | Invalid Token")
+            raise (f"401 Unauthorized | Invalid Token")
+
+    def set_options(self, options: dict) -> None:
+        # everything that can change from one job to the next
         self.path = options.get("path", os.getcwd())
         self.file = options.get("file", None)
         self.channel_ids = options.get("channel_ids", [])
@@ -18,12 +120,21 @@ class DiscordDownloader:
         self.sleep = options.get("sleep", 0)
         self.sleep_random = options.get("sleep_random", [0, 0])
         self.max_retries = options.get("max_retries", 10)
+        self.retry_policy = RetryPolicy(
+            self.max_retries,
+            options.get("retry_delay", 1.0),
+            options.get("max_retry_delay", 60.0),
+        )
+        self.chunk_size = options.get("chunk_size", 65536)
+        self.segment_threshold = options.get("segment_threshold", 64 * 2**20)
+        self.write_buffer = options.get("write_buffer", 4 * 2**20)
+        self.fsync = options.get("fsync", "none")
         self.date = options.get("date", None)
         self.date_before = options.get("date_before", None)
         self.date_after = options.get("date_after", None)
         self.username = options.get("username", [])
         self.user_id = options.get("user_id", [])
-        self.discord_api = "https://discord.com/api/v9"
+        self.filter = AttachmentFilter(options)
         self.channel_format = options.get(
             "channel_format", "downloads/{date:%Y-%m-%d}_{id}_{filename}.{ext}"
         )
@@ -35,9 +146,21 @@ class DiscordDownloader:
         self.simulate = options.get("simulate", False)
         self.temp_file = options.get("temp", True)
         self.resume_download = options.get("resume", False)
-
-        if self.token == None:
-            raise (f"No discord auth token passed")
+        self.incremental = options.get("incremental", False)
+        self.search = options.get("search", False)
+        # servers the search did not work for, their channels are paged through instead
+        self.search_unavailable = set()
+        self.resume_run = options.get("resume_run", False)
+        self.use_ledger = options.get("ledger", False)
+        self.plan = options.get("plan", None)
+        self.plan_format = options.get("plan_format", None)
+        self.verify = options.get("verify", False)
+        self.metadata_ttl = options.get("metadata_ttl", 86400)
+        self.refresh_metadata = options.get("refresh_metadata", False)
+        self.metrics_json = options.get("metrics_json", None)
+        self.metrics_prometheus = options.get("metrics_prometheus", None)
+        self.stats_interval = options.get("stats_interval", 0)
+        self.progress = self.renderer
 
         if os.path.isabs(self.channel_format):
             raise (
@@ -50,25 +173,43 @@ class DiscordDownloader:
         if not os.path.exists(self.path):
             raise (f"Download path does not exist: {self.path}")
 
-        self.channel_ids = extract_channel_ids(self.channel_ids)
-
-        headers = {
-            "Authorization": self.token,
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-        }
-        self.session = requests.Session()
-        self.session.headers.update(headers)
-
-        # check if token is valid
-        user_me = self.session.get(f"{self.discord_api}/users/@me").json()
+        if self.plan:
+            # a plan only reads the download path, nothing is downloaded or saved
+            self.simulate = True
+            self.progress = None
 
-        if user_me == {"message": "401: Unauthorized", "code": 0}:
-            logger.error(f"401 Unauthorized | Invalid Token")
-            raise (f"401 Unauthorized | Invalid Token")
+        self.server_ids = extract_server_ids(
+            options.get("server_ids", [])
+            + [value for value in self.channel_ids if is_server_url(value)]
+        )
+        self.channel_ids = extract_channel_ids(
+            [value for value in self.channel_ids if not is_server_url(value)]
+        )
+        self.before_snowflake, self.after_snowflake = self.get_snowflake_bounds()
+        if self.state is None or self.state.path != self.path:
+            if self.state:
+                self.state.close()
+            self.state = StateStore(self.path)
 
         for key, value in self.__dict__.items():
-            # do not print session object
-            if key == "session":
+            # do not print session objects, cached metadata or compiled filters
+            if key in (
+                "session",
+                "cdn_session",
+                "metadata",
+                "metadata_locks",
+                "filter",
+                "state",
+                "renderer",
+                "progress",
+                "search_unavailable",
+                "retry_policy",
+                "breaker",
+                "ledger",
+                "path_locks",
+                "parked",
+                "parked_lock",
+            ):
                 continue
             # DO NOT PRINT TOKEN!
             elif key == "token":
@@ -76,52 +217,207 @@ class DiscordDownloader:
             else:
                 logger.debug(f"{key}: {value}")
 
+    def get_snowflake_bounds(self) -> tuple:
+        # message ids are snowflakes that embed their creation time, so the date
+        # options can be turned into an exclusive (before, after) message id window
+        before = None
+        after = None
+        if self.date:
+            after = datetime_to_snowflake(self.date) - 1
+            before = datetime_to_snowflake(self.date + timedelta(days=1))
+        if self.date_before:
+            snowflake = datetime_to_snowflake(self.date_before)
+            before = snowflake if before is None else min(before, snowflake)
+        if self.date_after:
+            snowflake = datetime_to_snowflake(self.date_after + timedelta(days=1)) - 1
+            after = snowflake if after is None else max(after, snowflake)
+        return before, after
+
+    def get_metadata(self, route: str, refresh: bool = False, persist: bool = True) -> dict:
+        # memoized for the whole run and cached on disk for metadata_ttl seconds, so
+        # channels in the same server share a single server lookup. without persist it is
+        # only memoized
+        with self.metadata_lock:
+            route_lock = self.metadata_locks.setdefault(route, threading.Lock())
+        with route_lock:
+            refresh = refresh or self.refresh_metadata
+            if not refresh and route in self.metadata:
+                return self.metadata[route]
+            if not refresh and persist and self.metadata_ttl > 0:
+                cached = self.state.get_metadata(route, self.metadata_ttl)
+                if cached is not None:
+                    logger.debug(f"Using cached metadata for {route}")
+                    self.metadata[route] = cached
+                    return cached
+            with metrics.timer("metadata"):
+                response = self.get_api(route, route)
+            if response.status_code != 200:
+                self.invalidate_metadata(route)
+                response.raise_for_status()
+            metadata = response.json()
+            self.metadata[route] = metadata
+            if persist and self.metadata_ttl > 0:
+                self.state.set_metadata(route, metadata)
+            return metadata
+
+    def get_api(self, route: str, what: str, params: dict = None) -> requests.Response:
+        # a request to the api under the retry policy the messages and downloads use.
+        # returns the last response, a connection error that outlasted the retries is raised
+        retries = 0
+        while True:
+            try:
+                response = self.session.get(f"{self.discord_api}{route}", params=params)
+            except requests.exceptions.RequestException as e:
+                if not self.retry_policy.should_retry(classify_error(e), retries):
+                    raise
+                reason = str(e)
+            else:
+                if response.status_code == 200 or not self.retry_policy.should_retry(
+                    classify_status(response.status_code), retries
+                ):
+                    return response
+                reason = f"{response.status_code} {response.reason}"
+            metrics.increment("retries", kind="api")
+            logger.warning(
+                f"{reason} Failed to get {what}, retrying ({retries + 1}/{self.max_retries})"
+            )
+            self.retry_policy.wait(retries)
+            retries += 1
+
+    def remember_metadata(self, route: str, metadata) -> None:
+        # for metadata that came with another response, it is only kept for this run
+        self.metadata[route] = metadata
+
+    def invalidate_metadata(self, route: str) -> None:
+        self.metadata.pop(route, None)
+        self.state.delete_metadata(route)
+
     def get_server_info(self, guild_id: str) -> dict:
         logger.info(f"Getting server info for server id {guild_id}")
-        response = self.session.get(f"{self.discord_api}/guilds/{guild_id}").json()
-        server_info = {
-            "server_id": response["id"],
-            "server_name": response["name"],
-            "server_owner_id": response["owner_id"],
-        }
+        route = f"/guilds/{guild_id}"
+        response = self.get_metadata(route)
+        try:
+            server_info = {
+                "server_id": response["id"],
+                "server_name": response["name"],
+                "server_owner_id": response["owner_id"],
+            }
+        except KeyError:
+            self.invalidate_metadata(route)
+            raise
         return server_info
 
     def get_channel_info(self, channel_id: str) -> dict:
         logger.info(f"Getting channel info for channel id {channel_id}")
-        response = self.session.get(f"{self.discord_api}/channels/{channel_id}").json()
-        channel_info = {"channel_id": response["id"]}
-        # server channel
+        route = f"/channels/{channel_id}"
+        response = self.get_metadata(route)
+        try:
+            channel_info = {"channel_id": response["id"]}
+            # server channel
+            if "guild_id" in response:
+                channel_info["channel_name"] = response["name"]
+                # threads have no topic
+                channel_info["channel_topic"] = response.get("topic")
+        except KeyError:
+            self.invalidate_metadata(route)
+            raise
         if "guild_id" in response:
-            channel_info["channel_name"] = response["name"]
-            channel_info["channel_topic"] = response["topic"]
             server_info = self.get_server_info(response["guild_id"])
             channel_info = {**channel_info, **server_info}
         return channel_info
 
-    def get_all_messages(self, channel_id: str) -> list:
-        messages = []
-        last_message_id = None
+    def iter_message_pages(
+        self,
+        channel_id: str,
+        after_message_id: str = None,
+        before_message_id: str = None,
+        seen: int = 0,
+    ):
+        # lazily walks the channel one page at a time. by default pages go from the newest
+        # message backwards, when after_message_id is given they go forwards from it and
+        # every page is returned oldest message first. before_message_id and seen continue
+        # a backwards walk that was interrupted
+        if self.message_count == 0:
+            return
+        ascending = after_message_id is not None
+        lower_bound = self.after_snowflake
+        if ascending and (lower_bound is None or int(after_message_id) > lower_bound):
+            lower_bound = int(after_message_id)
+        last_message_id = None if ascending else self.before_snowflake
+        if not ascending and before_message_id is not None:
+            if last_message_id is None or int(before_message_id) < last_message_id:
+                last_message_id = int(before_message_id)
         while True:
-            messages_chunk = self.retrieve_messages(
-                channel_id, before_message_id=last_message_id
-            )
-            messages += messages_chunk
-            last_message_id = messages_chunk[-1]["id"]
-            if self.message_count >= 0 and len(messages) >= self.message_count:
-                logger.debug(
-                    f"Got {len(messages[:self.message_count])} messages for channel id {channel_id}"
+            if ascending:
+                messages_chunk = self.retrieve_messages(
+                    channel_id, after_message_id=last_message_id or lower_bound
                 )
-                return self.find_messages(messages[: self.message_count])
-            if len(messages_chunk) < 50:
-                logger.debug(
-                    f"Got {len(messages)} messages for channel id {channel_id}"
+            else:
+                messages_chunk = self.retrieve_messages(
+                    channel_id, before_message_id=last_message_id
                 )
-                return self.find_messages(messages)
+            if not messages_chunk:
+                break
+            full_page = len(messages_chunk) >= MESSAGES_PER_PAGE
+            if ascending:
+                messages_chunk = messages_chunk[::-1]
+                if self.before_snowflake is not None and int(
+                    messages_chunk[-1]["id"]
+                ) >= self.before_snowflake:
+                    # passed the end of the date window
+                    messages_chunk = [
+                        message
+                        for message in messages_chunk
+                        if int(message["id"]) < self.before_snowflake
+                    ]
+                    full_page = False
+            elif self.after_snowflake is not None and int(
+                messages_chunk[-1]["id"]
+            ) <= self.after_snowflake:
+                # passed the start of the date window, nothing older is wanted
+                messages_chunk = [
+                    message
+                    for message in messages_chunk
+                    if int(message["id"]) > self.after_snowflake
+                ]
+                full_page = False
+            if self.message_count >= 0 and seen + len(messages_chunk) >= self.message_count:
+                messages_chunk = messages_chunk[: self.message_count - seen]
+                full_page = False
+            seen += len(messages_chunk)
+            if messages_chunk:
+                yield messages_chunk
+            if not full_page:
+                break
+            last_message_id = messages_chunk[-1]["id"]
             mysleep(self.sleep, self.sleep_random)
+        logger.debug(f"Got {seen} messages for channel id {channel_id}")
 
-    def retrieve_messages(self, channel_id: str, before_message_id: str = None) -> list:
-        params = {"limit": 50}
-        if before_message_id:
+    def get_all_messages(self, channel_id: str):
+        # filters each page as it arrives so memory use does not grow with the channel size
+        for messages_chunk in self.iter_message_pages(channel_id):
+            yield from self.find_messages(messages_chunk)
+
+    def retrieve_messages(
+        self,
+        channel_id: str,
+        before_message_id: str = None,
+        after_message_id: str = None,
+        around_message_id: str = None,
+        limit: int = MESSAGES_PER_PAGE,
+    ) -> list:
+        params = {"limit": limit}
+        if around_message_id:
+            logger.info(
+                f"Getting message id {around_message_id} for channel id {channel_id}"
+            )
+            params["around"] = around_message_id
+        elif after_message_id:
+            logger.info(
+                f"Getting messages after message id {after_message_id} for channel id {channel_id}"
+            )
+            params["after"] = after_message_id
+        elif before_message_id:
             logger.info(
                 f"Getting messages before message id {before_message_id} for channel id {channel_id}"
             )
@@ -129,60 +425,171 @@ class DiscordDownloader:
         else:
             logger.info(f"Getting messages for channel id {channel_id}")
         retries = 0
-        while retries < self.max_retries:
+        while True:
             try:
-                messages = self.session.get(
-                    f"{self.discord_api}/channels/{channel_id}/messages",
-                    params=params,
-                ).json()
-            except ConnectionError:
-                retries += 1
-                sleep = 30 * retries
-                logger.warning(
-                    f"{messages.status_code} Failed to get messages with url: {messages.url}"
+                with metrics.timer("pagination"):
+                    response = self.session.get(
+                        f"{self.discord_api}/channels/{channel_id}/messages",
+                        params=params,
+                    )
+            except requests.exceptions.RequestException as e:
+                reason = str(e)
+                kind = classify_error(e)
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                reason = f"{response.status_code} {response.reason}"
+                kind = classify_status(response.status_code)
+            if not self.retry_policy.should_retry(kind, retries):
+                break
+            metrics.increment("retries", kind="messages")
+            logger.warning(
+                f"{reason} Failed to get messages for channel id {channel_id}, retrying ({retries + 1}/{self.max_retries})"
+            )
+            self.retry_policy.wait(retries)
+            retries += 1
+        if retries:
+            logger.error(
+                f"{reason} All {retries} retries failed to get messages for channel id {channel_id}"
+            )
+        else:
+            logger.error(f"{reason} Failed to get messages for channel id {channel_id}")
+        return []
+
+    def iter_search_pages(
+        self,
+        guild_id: str,
+        channel_id: str,
+        after_message_id: str = None,
+        before_message_id: str = None,
+        seen: int = 0,
+    ):
+        # the same pages as iter_message_pages, but only of the messages with files, found
+        # with the server search. the bounds move with every page instead of using an offset,
+        # because the search does not page past a few thousand results. when the search can
+        # not be used, the channel is paged through from where the search stopped
+        if self.message_count == 0:
+            return
+        ascending = after_message_id is not None
+        lower_bound = self.after_snowflake
+        if ascending and (lower_bound is None or int(after_message_id) > lower_bound):
+            lower_bound = int(after_message_id)
+        upper_bound = self.before_snowflake
+        if not ascending and before_message_id is not None:
+            if upper_bound is None or int(before_message_id) < upper_bound:
+                upper_bound = int(before_message_id)
+        params = {
+            "channel_id": channel_id,
+            "has": "file",
+            "sort_by": "timestamp",
+            "sort_order": "asc" if ascending else "desc",
+            "include_nsfw": "true",
+        }
+        if self.user_id:
+            params["author_id"] = self.user_id
+        while True:
+            if lower_bound is not None:
+                params["min_id"] = lower_bound
+            if upper_bound is not None:
+                params["max_id"] = upper_bound
+            results = self.search_messages(guild_id, params)
+            if results is None:
+                self.search_unavailable.add(guild_id)
+                logger.info(f"Paging through channel id {channel_id} instead")
+                yield from self.iter_message_pages(
+                    channel_id,
+                    after_message_id=str(lower_bound) if ascending else None,
+                    before_message_id=None if ascending else upper_bound,
+                    seen=seen,
                 )
-                logger.info(f"Sleeping for {sleep} seconds")
-                time.sleep(sleep)
-                logger.info(f"Retrying download {retries}/{self.max_retries}")
+                return
+            full_page = len(results) >= SEARCH_RESULTS_PER_PAGE
+            # the bounds are exclusive, but the api is not trusted to treat them that way
+            messages_chunk = [
+                message
+                for message in results
+                if (lower_bound is None or int(message["id"]) > lower_bound)
+                and (upper_bound is None or int(message["id"]) < upper_bound)
+            ]
+            if self.message_count >= 0 and seen + len(messages_chunk) >= self.message_count:
+                messages_chunk = messages_chunk[: self.message_count - seen]
+                full_page = False
+            seen += len(messages_chunk)
+            if not messages_chunk:
+                break
+            yield messages_chunk
+            if not full_page:
+                break
+            if ascending:
+                lower_bound = int(messages_chunk[-1]["id"])
             else:
-                return messages
+                upper_bound = int(messages_chunk[-1]["id"])
+            mysleep(self.sleep, self.sleep_random)
+        logger.debug(f"Found {seen} messages with files for channel id {channel_id}")
 
-    def find_messages(self, messages: list) -> list:
-        filtered_data = []
-        for message in messages:
-            message_date = convert_discord_timestamp(message["timestamp"]).replace(
-                hour=0, minute=0, second=0, microsecond=0, tzinfo=None
+    def search_messages(self, guild_id: str, params: dict):
+        # returns the messages of one search page, or None when the search can not be used
+        logger.info(f"Searching messages with files for channel id {params['channel_id']}")
+        retries = 0
+        while True:
+            try:
+                with metrics.timer("search"):
+                    response = self.session.get(
+                        f"{self.discord_api}/guilds/{guild_id}/messages/search",
+                        params=params,
+                    )
+            except requests.exceptions.RequestException as e:
+                reason = str(e)
+                kind = classify_error(e)
+            else:
+                if response.status_code == 200:
+                    # every result is a list of the matching message, older api versions
+                    # add the messages around it and mark the match as the hit
+                    messages = []
+                    for result in response.json().get("messages", []):
+                        message = next(
+                            (message for message in result if message.get("hit")), result[0]
+                        )
+                        if not messages or messages[-1]["id"] != message["id"]:
+                            messages.append(message)
+                    return messages
+                if response.status_code == 202:
+                    # the server is not indexed yet, the response says when to ask again
+                    retry_after = response.json().get("retry_after", 5)
+                    logger.info(
+                        f"Server id {guild_id} is being indexed for search, waiting {retry_after} seconds"
+                    )
+                    with metrics.timer("backoff"):
+                        time.sleep(retry_after)
+                    continue
+                reason = f"{response.status_code} {response.reason}"
+                kind = classify_status(response.status_code)
+            if not self.retry_policy.should_retry(kind, retries):
+                break
+            metrics.increment("retries", kind="search")
+            logger.warning(
+                f"{reason} Failed to search server id {guild_id}, retrying ({retries + 1}/{self.max_retries})"
             )
-            if self.date and message_date != self.date:
-                logger.debug(
-                    f"Message date {message_date:%Y-%m-%d} != args.date {self.date:%Y-%m-%d} for message id {message['id']}"
-                )
-                continue
-            if self.date_before and message_date >= self.date_before:
-                logger.debug(
-                    f"Message date {message_date:%Y-%m-%d} >= args.date_before {self.date_before:%Y-%m-%d} for message id {message['id']}"
-                )
-                continue
-            if self.date_after and message_date <= self.date_after:
-                logger.debug(
-                    f"Message date {message_date:%Y-%m-%d} <= args.date_after {self.date_after:%Y-%m-%d} for message id {message['id']}"
-                )
-                continue
-            if self.username and message["author"]["username"] not in self.username:
-                logger.debug(
-                    f"Message username {message['author']['username']} is not in args.username {self.username} for message id {message['id']}"
-                )
-                continue
-            if self.user_id and message["author"]["id"] not in self.user_id:
-                logger.debug(
-                    f"Message user id {message['author']['id']} is not in args.user_id {self.user_id} for message id {message['id']}"
-                )
-                continue
-            filtered_data.append(message)
-        return filtered_data
+            self.retry_policy.wait(retries)
+            retries += 1
+        # bot accounts and servers without search get a 403
+        logger.warning(f"{reason} Can not search server id {guild_id}")
+        return None
+
+    def get_message(self, channel_id: str, message_id: str):
+        # user accounts can not request a single message, so it is the page around it
+        for message in self.retrieve_messages(
+            channel_id, around_message_id=message_id, limit=1
+        ):
+            if message["id"] == message_id:
+                return message
+        return None
+
+    def find_messages(self, messages: list) -> list:
+        return [message for message in messages if self.filter.match_message(message)]
 
-    def download_attachment(self, attachment: dict, variables: dict) -> None:
-        filepath = create_filepath(
+    def get_filepath(self, variables: dict) -> str:
+        return create_filepath(
             variables,
             self.path,
             self.channel_format,
@@ -190,61 +597,445 @@ class DiscordDownloader:
             self.windows_filenames,
             self.restrict_filenames,
         )
-        retries = 0
-        while retries < self.max_retries:
-            result, reason = download_file(
-                self.session,
-                attachment["url"],
-                filepath,
-                self.temp_file,
-                self.resume_download,
-                self.simulate,
-            )
-            if result == 200:
-                return
-            elif result == 1:
-                logger.info(reason)
-                return
-            elif result == 404:
+
+    def download_attachment(
+        self, attachment: dict, variables: dict, filepath: str = None, park: bool = False
+    ) -> str:
+        # with park, an attachment that keeps failing is given up on after a couple of
+        # quick retries and "parked" is returned, so it does not hold up the run
+        filepath = filepath or self.get_filepath(variables)
+        with self.lock_path(filepath):
+            if not self.verify and self.is_downloaded(attachment, filepath):
+                logger.debug(f"Skipping {filepath}, already in the download manifest")
+                return "skipped"
+            max_retries = min(self.max_retries, PARK_AFTER_RETRIES) if park else self.max_retries
+            retries = 0
+            refreshed = False
+            while True:
+                try:
+                    result, reason, md5 = download_file(
+                        self.cdn_session,
+                        attachment["url"],
+                        filepath,
+                        self.temp_file,
+                        self.resume_download,
+                        self.simulate,
+                        self.progress,
+                        self.chunk_size,
+                        size=attachment.get("size", 0),
+                        segments=self.segments,
+                        segment_threshold=self.segment_threshold,
+                        write_buffer=self.write_buffer,
+                        fsync=self.fsync,
+                    )
+                except requests.exceptions.RequestException as e:
+                    # the connection broke while the body was streaming in
+                    result, reason = type(e).__name__, str(e)
+                    kind = classify_error(e)
+                else:
+                    if result == 200 or result == 206:
+                        self.save_attachment(attachment, variables, filepath, md5)
+                        return "downloaded"
+                    elif result == 1:
+                        logger.info(reason)
+                        self.save_attachment(attachment, variables, filepath, md5)
+                        return "skipped"
+                    # 2 is a download that ended early or with the wrong hash, 416 a partial
+                    # file that did not fit, both start over on the next try
+                    kind = "incomplete" if result in (2, 416) else classify_status(result)
+                if kind == "forbidden" and not refreshed:
+                    # attachment urls are signed and expire, the message has a fresh one
+                    refreshed = True
+                    fresh = self.refresh_attachment(attachment, variables)
+                    if fresh:
+                        attachment = fresh
+                        continue
+                if not self.retry_policy.should_retry(kind, retries, max_retries):
+                    break
+                metrics.increment("retries", kind="attachment")
                 logger.warning(
-                    f"{result} {reason} Failed to download url: {attachment['url']}"
+                    f"{result} {reason} Failed to download attachment, retrying ({retries + 1}/{max_retries})"
                 )
-                return
-            else:
+                self.retry_policy.wait(retries)
                 retries += 1
-                sleep = 30 * retries
-                logger.warning(
-                    f"{result} {reason} Failed to download attachment. Retrying ({retries}/{self.max_retries}) in {sleep} seconds."
+
+            if park and kind in RETRYABLE:
+                logger.info(f"{result} {reason} Retrying {attachment['url']} at the end of the run")
+                return "parked"
+            if retries:
+                logger.error(
+                    f"{result} {reason} All {retries} retries failed to download url: {attachment['url']}"
                 )
-                time.sleep(sleep)
+            else:
+                logger.warning(f"{result} {reason} Failed to download url: {attachment['url']}")
+            return "failed"
+
+    @contextmanager
+    def lock_path(self, filepath: str):
+        # downloads to the same path run one after the other, the later one then goes
+        # through the usual check of the existing file instead of writing into the same
+        # .part file
+        with self.path_locks_lock:
+            entry = self.path_locks.setdefault(filepath, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.path_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.path_locks[filepath]
+
+    def refresh_attachment(self, attachment: dict, variables: dict):
+        try:
+            message = self.get_message(variables["channel_id"], variables["message_id"])
+        except requests.exceptions.RequestException:
+            return None
+        for fresh in message["attachments"] if message else []:
+            if fresh["id"] == attachment["id"]:
+                logger.debug(f"Refreshed the url of attachment id {attachment['id']}")
+                return fresh
+        return None
+
+    def is_downloaded(self, attachment: dict, filepath: str) -> bool:
+        # a single stat against the manifest instead of a cdn request and a full hash
+        entry = self.state.get_attachment(attachment["id"])
+        if entry is None or entry["path"] != filepath:
+            return False
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        if stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+            return False
+        return attachment.get("size", entry["size"]) == entry["size"]
 
-        logger.error(
-            f"All {self.max_retries} retries failed to download url: {attachment['url']}"
+    def save_attachment(
+        self, attachment: dict, variables: dict, filepath: str, md5: str
+    ) -> None:
+        if self.simulate or md5 is None:
+            return
+        stat = os.stat(filepath)
+        self.state.set_attachment(
+            attachment["id"],
+            variables.get("channel_id"),
+            variables.get("message_id"),
+            filepath,
+            stat.st_size,
+            md5,
+            stat.st_mtime,
         )
 
-    def download(self):
-        # direct messages and channels are functionally the same
-        for channel_id in self.channel_ids:
-            channel_messages = self.get_all_messages(channel_id)
+    def download_job(self, job: tuple) -> str:
+        attachment, variables, progress = job
+        if self.ledger and not self.ledger.holds(variables["channel_id"]):
+            # the channel was taken over by another process, which downloads it
+            return "released"
+        result = self.download_attachment(attachment, variables, park=self.parking)
+        if result == "parked":
+            # still pending in the channel progress and the journal
+            with self.parked_lock:
+                self.parked.append(job)
+            return result
+        if progress:
+            progress.done(variables["message_id"], result != "failed")
+        if self.journal and result != "failed":
+            self.journal.attachment_done(variables["channel_id"], attachment["id"])
+        if self.ledger:
+            self.ledger.attachment_done(variables["channel_id"])
+        return result
+
+    def plan_job(self, job: tuple) -> str:
+        # compares the target path against disk instead of downloading
+        attachment, variables, _ = job
+        filepath = self.get_filepath(variables)
+        if self.is_downloaded(attachment, filepath):
+            status = "downloaded"
+        else:
+            try:
+                size = os.path.getsize(filepath)
+            except OSError:
+                status = "new"
+            else:
+                status = "exists" if size == attachment.get("size") else "conflict"
+        self.planner.add(attachment, variables, filepath, status)
+        return "planned"
+
+    def save_progress(self, channel_id: str, message_id: str) -> None:
+        if self.simulate:
+            return
+        logger.debug(f"Saving message id {message_id} as processed for channel id {channel_id}")
+        self.state.set_last_message_id(channel_id, message_id)
+
+    def queue_message(
+        self, pipeline: DownloadPipeline, message: dict, channel_variables: dict, progress
+    ) -> None:
+        attachments = []
+        for attachment in message["attachments"]:
+            if "https://cdn.discordapp.com" == attachment["url"][:27]:
+                logger.warning(f"Attachment not hosted by discord {attachment['url']}")
+                continue
+            if not self.filter.match_attachment(attachment):
+                continue
+            attachments.append(attachment)
+        if progress:
+            progress.add(message["id"], len(attachments))
+        if not attachments:
+            return
+        message_variables = {**create_message_variables(message), **channel_variables}
+        if self.ledger:
+            self.ledger.attachments_queued(channel_variables["channel_id"], len(attachments))
+        for attachment in attachments:
+            variables = {**create_attachment_variables(attachment), **message_variables}
+            logger.debug(f"Format variables: {variables}")
+            if self.journal:
+                self.journal.attachment_queued(variables["channel_id"], message, attachment)
+            pipeline.put((attachment, variables, progress), variables["channel_id"])
+
+    def download_channel(self, pipeline: DownloadPipeline, channel_id: str) -> bool:
+        # returns whether every page of the channel was queued, false when it stopped early
+        journal_channel = self.journal.get_channel(channel_id) if self.journal else {}
+        if journal_channel.get("done") and not self.journal.get_pending(channel_id):
+            logger.info(f"Skipping channel id {channel_id}, it was finished by the interrupted run")
+            return True
+        try:
             channel_variables = self.get_channel_info(channel_id)
-            for message in channel_messages:
-                for attachment in message["attachments"]:
-                    if "https://cdn.discordapp.com" == attachment["url"][:27]:
-                        logger.warning(
-                            f"Attachment not hosted by discord {attachment['url']}"
-                        )
-                        continue
-                    variables = {
-                        **create_format_variables(message, attachment),
-                        **channel_variables,
+        except requests.exceptions.HTTPError as e:
+            # a thread from the state that was deleted, or that can no longer be read
+            if e.response.status_code not in (403, 404) or not self.state.delete_threads([channel_id]):
+                raise
+            logger.warning(
+                f"{e.response.status_code} {e.response.reason} Removed thread id {channel_id}, it can no longer be read"
+            )
+            return True
+        last_message_id = None
+        progress = None
+        if self.incremental:
+            last_message_id = self.state.get_last_message_id(channel_id)
+            if last_message_id:
+                logger.info(
+                    f"Resuming channel id {channel_id} after message id {last_message_id}"
+                )
+            progress = ChannelProgress(
+                channel_id,
+                self.save_progress,
+                ascending=last_message_id is not None,
+            )
+        ascending = last_message_id is not None
+        cursor = journal_channel.get("cursor")
+        seen = journal_channel.get("seen", 0)
+        newest = journal_channel.get("newest")
+        # the unfinished attachments from the journal. their page is fetched again when the
+        # run stopped before its cursor was written, so they are left out of it
+        requeued = set()
+        if self.journal:
+            # attachments the interrupted run queued but did not finish
+            pending = self.journal.get_pending(channel_id)
+            if pending:
+                logger.info(
+                    f"Queueing {sum(len(message['attachments']) for message in pending)} "
+                    f"unfinished attachments for channel id {channel_id}"
+                )
+            for message in sorted(
+                pending, key=lambda message: int(message["id"]), reverse=not ascending
+            ):
+                requeued.update(attachment["id"] for attachment in message["attachments"])
+                self.queue_message(pipeline, message, channel_variables, progress)
+            if progress and newest:
+                progress.add(newest)
+        # direct messages can not be searched
+        guild_id = channel_variables.get("server_id")
+        if self.search and guild_id and guild_id not in self.search_unavailable:
+            pages = partial(self.iter_search_pages, guild_id)
+        else:
+            pages = self.iter_message_pages
+        if journal_channel.get("done"):
+            # paged through by the interrupted run, only its unfinished attachments are left
+            chunks = []
+        else:
+            if cursor:
+                logger.info(f"Continuing channel id {channel_id} from message id {cursor}")
+            chunks = pages(
+                channel_id,
+                after_message_id=cursor if ascending and cursor else last_message_id,
+                before_message_id=None if ascending else cursor,
+                seen=seen,
+            )
+        for messages_chunk in chunks:
+            if pipeline.stop_event.is_set():
+                return False
+            if self.ledger and not self.ledger.holds(channel_id):
+                return False
+            for message in self.find_messages(messages_chunk):
+                if requeued:
+                    message = {
+                        **message,
+                        "attachments": [
+                            attachment
+                            for attachment in message["attachments"]
+                            if attachment["id"] not in requeued
+                        ],
                     }
-                    logger.debug(f"Format variables: {variables}")
-                    self.download_attachment(attachment, variables)
-                    # do not sleep after last download...
-                    if (
-                        channel_id == self.channel_ids[-1]
-                        and message == channel_messages[-1]
-                        and attachment == message["attachments"][-1]
-                    ):
-                        continue
-                    mysleep(self.sleep, self.sleep_random)
+                self.queue_message(pipeline, message, channel_variables, progress)
+            page_newest = max(messages_chunk, key=lambda message: int(message["id"]))["id"]
+            if progress:
+                # covers the messages that were filtered out of the page
+                progress.add(page_newest)
+            if self.journal:
+                seen += len(messages_chunk)
+                if newest is None or int(page_newest) > int(newest):
+                    newest = page_newest
+                # the last message of a page is where the next page starts in both directions
+                self.journal.page_queued(channel_id, messages_chunk[-1]["id"], seen, newest)
+        if progress:
+            progress.close()
+        if self.journal:
+            self.journal.channel_done(channel_id)
+        return True
+
+    def channel_worker(self, pipeline: DownloadPipeline, channel_ids: queue.Queue) -> None:
+        while not pipeline.stop_event.is_set():
+            if self.ledger:
+                channel_id = self.ledger.claim(pipeline.stop_event)
+                if channel_id is None:
+                    return
+            else:
+                try:
+                    channel_id = channel_ids.get_nowait()
+                except queue.Empty:
+                    return
+            try:
+                paged = self.download_channel(pipeline, channel_id)
+            except Exception:
+                logger.exception(f"Failed to download channel id {channel_id}")
+                with pipeline.lock:
+                    pipeline.summary["failed_channels"] = pipeline.summary.get("failed_channels", 0) + 1
+                if self.ledger:
+                    self.ledger.channel_failed(channel_id)
+                continue
+            if not self.ledger:
+                continue
+            if paged:
+                self.ledger.channel_paged(channel_id)
+            else:
+                # interrupted, or the lease was lost. the rest of the channel is paged by
+                # whoever claims it next
+                self.ledger.release(channel_id)
+
+    def discover_channels(self) -> list:
+        # the channel ids that were given, followed by every channel and thread of the servers
+        discovery = GuildDiscovery(self, self.concurrent_channels)
+        channel_ids = list(self.channel_ids)
+        for server_id in self.server_ids:
+            try:
+                channel_ids += discovery.discover(server_id)
+            except Exception:
+                logger.exception(f"Failed to list the channels of server id {server_id}")
+        return list(dict.fromkeys(channel_ids))
+
+    def download(self) -> dict:
+        # returns the number of attachments per result, or the plan summary
+        self.journal = None
+        self.ledger = None
+        self.planner = None
+        self.parked = []
+        # with the ledger a channel is only done once its attachments are, and processes
+        # wait for each other's channels, so nothing can be held back for the end
+        self.parking = not self.use_ledger
+        # a service runs many jobs, names may have changed and directories been moved away
+        # since the last one. metadata_ttl still applies to the cache on disk
+        self.metadata = {}
+        forget_directories()
+        if self.server_ids:
+            self.channel_ids = self.discover_channels()
+        if self.use_ledger and not self.simulate:
+            # the journal of the download path belongs to a single process, the ledger
+            # takes its place
+            self.ledger = ChannelLedger(self.state.db_path, self.channel_ids)
+        elif not self.simulate:
+            self.journal = RunJournal(
+                self.path,
+                resume=self.resume_run,
+                require_run=self.resume_run and not self.channel_ids,
+            )
+            if self.resume_run and not self.channel_ids:
+                self.channel_ids = self.journal.channel_ids
+            self.journal.start_run(self.channel_ids)
+        metrics.start_reporter(self.stats_interval, self.metrics_prometheus)
+        if self.progress:
+            self.progress.start()
+        if self.plan:
+            self.planner = PlanWriter(self.plan, self.plan_format)
+            # a single worker keeps the plan in the order the attachments were found
+            pipeline = DownloadPipeline(self.plan_job, 1)
+        else:
+            pipeline = DownloadPipeline(
+                self.download_job,
+                self.concurrent_downloads,
+                pause=lambda: mysleep(self.sleep, self.sleep_random),
+            )
+        pipeline.start()
+        # direct messages and channels are functionally the same
+        channel_ids = queue.Queue()
+        for channel_id in self.channel_ids:
+            channel_ids.put(channel_id)
+        producers = []
+        # with the ledger the channels come from every process using the download path
+        workers = self.concurrent_channels
+        if not self.ledger:
+            workers = min(workers, len(self.channel_ids))
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self.channel_worker,
+                args=(pipeline, channel_ids),
+                name=f"channel-worker-{i}",
+                daemon=True,
+            )
+            thread.start()
+            producers.append(thread)
+        interrupted = False
+        try:
+            join_threads(producers)
+            pipeline.close()
+            if self.parked:
+                # failures were set aside so they did not hold up the rest of the run, now
+                # they get every retry
+                logger.info(f"Retrying {len(self.parked)} attachments that failed during the run")
+                self.parking = False
+                parked, self.parked = self.parked, []
+                pipeline.summary.pop("parked", None)
+                pipeline.reopen()
+                for job in parked:
+                    pipeline.put(job, job[1]["channel_id"])
+                pipeline.close()
+        except KeyboardInterrupt:
+            interrupted = True
+            pipeline.abort()
+        if self.journal:
+            self.journal.close()
+        if self.ledger:
+            self.ledger.close()
+        if self.progress:
+            self.progress.stop()
+        if self.planner:
+            self.planner.close()
+        else:
+            pipeline.log_summary()
+        metrics.stop_reporter()
+        self.write_metrics()
+        summary = self.planner.summary() if self.planner else dict(pipeline.summary)
+        return {**summary, "interrupted": interrupted}
+
+    def close(self) -> None:
+        self.state.close()
+        self.session.close()
+        self.cdn_session.close()
+
+    def write_metrics(self) -> None:
+        logger.debug(metrics.stats_line())
+        if self.metrics_json:
+            logger.info(f"Writing run metrics to {self.metrics_json}")
+            metrics.write_json(self.metrics_json)
+        if self.metrics_prometheus:
+            metrics.write_prometheus(self.metrics_prometheus)
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import logger
+from metrics import metrics
+from utils import convert_discord_timestamp
+
+# channel types that have messages of their own: text, voice, announcement and stage
+TEXT_CHANNEL_TYPES = {0, 2, 5, 13}
+# channel types that can have threads: text, announcement, forum and media
+THREAD_PARENT_TYPES = {0, 5, 15, 16}
+ARCHIVED_THREAD_KINDS = ("public", "private")
+PRIVATE_THREAD_TYPE = 12
+THREADS_PER_PAGE = 100
+
+
+class GuildDiscovery:
+    def __init__(self, downloader, workers: int = 4) -> None:
+        self.downloader = downloader
+        self.workers = max(1, workers)
+
+    def discover(self, guild_id: str) -> list:
+        # returns the ids of every text channel and thread of the server that can be read
+        with metrics.timer("discovery"):
+            # looked up on every run like the threads, a cached list would miss new channels
+            channels = self.downloader.get_metadata(f"/guilds/{guild_id}/channels", persist=False)
+            channels = sorted(channels, key=lambda channel: channel.get("position", 0))
+            text_channels = [
+                channel for channel in channels if channel["type"] in TEXT_CHANNEL_TYPES
+            ]
+            parents = [channel for channel in channels if channel["type"] in THREAD_PARENT_TYPES]
+
+            threads = {thread["id"]: thread for thread in self.get_active_threads(guild_id)}
+            # the threads that came with a response of this run, the others are from the state
+            listed = set(threads)
+            # archived threads are listed per channel, so the channels are paged in parallel
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for archived, found in executor.map(
+                    lambda task: self.get_archived_threads(*task),
+                    [(parent["id"], kind) for parent in parents for kind in ARCHIVED_THREAD_KINDS],
+                ):
+                    listed.update(found)
+                    for thread in archived:
+                        threads.setdefault(thread["id"], thread)
+
+        # the channel objects are what get_channel_info would request again. stored threads
+        # are looked up, so the ones that were deleted or can no longer be read are noticed
+        fresh = [thread for thread_id, thread in threads.items() if thread_id in listed]
+        for channel in text_channels + fresh:
+            self.downloader.remember_metadata(f"/channels/{channel['id']}", channel)
+        logger.info(
+            f"Found {len(text_channels)} channels and {len(threads)} threads in server id {guild_id}"
+        )
+        return [channel["id"] for channel in text_channels] + list(threads)
+
+    def get_active_threads(self, guild_id: str) -> list:
+        downloader = self.downloader
+        response = downloader.get_api(
+            f"/guilds/{guild_id}/threads/active", f"the active threads of server id {guild_id}"
+        )
+        if response.status_code != 200:
+            logger.warning(
+                f"{response.status_code} {response.reason} Could not list the active threads of server id {guild_id}"
+            )
+            return []
+        return response.json().get("threads", [])
+
+    def get_archived_threads(self, channel_id: str, kind: str) -> tuple:
+        # archived threads come newest archived first. pages are only requested until
+        # the newest archive timestamp of the last run, older threads come from the state.
+        # returns the stored threads of the kind and the ids of the ones listed now
+        downloader = self.downloader
+        state = downloader.state
+        known = None if downloader.refresh_metadata else state.get_thread_cursor(channel_id, kind)
+        known_time = convert_discord_timestamp(known) if known else None
+        newest = None
+        before = None
+        found = []
+        complete = False
+        while True:
+            params = {"limit": THREADS_PER_PAGE}
+            if before:
+                params["before"] = before
+            response = downloader.get_api(
+                f"/channels/{channel_id}/threads/archived/{kind}",
+                f"the {kind} archived threads of channel id {channel_id}",
+                params,
+            )
+            if response.status_code in (403, 404):
+                # private threads need the manage threads permission
+                logger.debug(f"Can not list {kind} archived threads of channel id {channel_id}")
+                complete = True
+                break
+            if response.status_code != 200:
+                logger.warning(
+                    f"{response.status_code} {response.reason} Could not list the {kind} archived threads of channel id {channel_id}"
+                )
+                break
+            page = response.json()
+            threads = page.get("threads", [])
+            reached_known = False
+            for thread in threads:
+                archive_timestamp = thread["thread_metadata"]["archive_timestamp"]
+                archive_time = convert_discord_timestamp(archive_timestamp)
+                if known_time and archive_time <= known_time:
+                    reached_known = True
+                    break
+                if newest is None or archive_time > newest[0]:
+                    newest = (archive_time, archive_timestamp)
+                found.append(thread)
+            if reached_known or not threads or not page.get("has_more"):
+                complete = True
+                break
+            before = threads[-1]["thread_metadata"]["archive_timestamp"]
+        if found:
+            state.set_threads(found)
+        listed = {thread["id"] for thread in found}
+        # public and private threads of the channel are stored together
+        stored = [
+            thread
+            for thread in state.get_threads(channel_id)
+            if (thread["type"] == PRIVATE_THREAD_TYPE) == (kind == "private")
+        ]
+        if complete and known is None and response.status_code == 200:
+            # every archived thread was listed, the stored ones that were not are gone
+            stale = [thread["id"] for thread in stored if thread["id"] not in listed]
+            if stale:
+                state.delete_threads(stale)
+                logger.debug(f"Removed {len(stale)} {kind} archived threads of channel id {channel_id} that are gone")
+                stored = [thread for thread in stored if thread["id"] in listed]
+        # the cursor only moves once every newer thread is saved
+        if complete and newest:
+            state.set_thread_cursor(channel_id, kind, newest[1])
+        logger.debug(f"Found {len(found)} new {kind} archived threads in channel id {channel_id}")
+        return stored, listed
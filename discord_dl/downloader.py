@@ -1,9 +1,28 @@
+import hashlib
+import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import requests
 from logger import logger
-from utils import calculate_md5
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+from retry import CircuitBreakerAdapter, backoff
+from utils import calculate_md5, etag_md5, update_md5
+from writer import BufferedFileWriter
+
+# how often the resume state of a partial download is saved
+RESUME_STATE_INTERVAL = 8 * 2**20
+RESUME_STATE_SUFFIX = ".resume"
+
+# how many times a single segment of a segmented download is retried
+SEGMENT_RETRIES = 3
+
+# directories known to exist, shared by every download thread
+created_directories = set()
 
 # def download_file(
 #     session: requests.Session, url: str, filepath: str, simulate=False
@@ -48,6 +67,26 @@ from utils import calculate_md5
 #         print()
 #     return r.status_code
 
+class SegmentError(Exception):
+    pass
+
+
+def create_cdn_session(
+    pool_size: int, user_agent: str = None, breaker=None
+) -> requests.Session:
+    # the cdn rejects requests that carry the api Authorization header, so attachments
+    # use their own keep-alive session with a connection pool per download worker.
+    # pool_block caps the number of open cdn connections across all channels
+    session = requests.Session()
+    pool = {"pool_connections": 4, "pool_maxsize": max(1, pool_size), "pool_block": True}
+    adapter = CircuitBreakerAdapter(breaker, **pool) if breaker else HTTPAdapter(**pool)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if user_agent:
+        session.headers["User-Agent"] = user_agent
+    return session
+
+
 def download_file(
     session: requests.Session,
     url: str,
@@ -55,143 +94,444 @@ def download_file(
     temp_file=True,
     resume=True,
     simulate=False,
-) -> tuple[int, str]:
+    progress=None,
+    chunk_size=8192,
+    size=0,
+    segments=1,
+    segment_threshold=0,
+    write_buffer=0,
+    fsync="none",
+) -> tuple[int, str, str]:
+    # returns (status, reason, md5), md5 is only set when the file on disk is known to be complete
     file_path, filename = os.path.split(filepath)
     temp_filepath = filepath + ".part"
     file = temp_filepath if temp_file else filepath
+    state_filepath = file + RESUME_STATE_SUFFIX
 
     logger.info(f"Downloading: {filename}")
     logger.debug(f"Path: {file_path}")
     logger.debug(f"URL: {url}")
 
-    range_header = {}
+    # size is the attachment size discord reports, so large files are split up front
+    if segments > 1 and size and size >= segment_threshold and not simulate:
+        result = download_segmented(
+            session,
+            url,
+            filepath,
+            temp_file,
+            resume,
+            progress,
+            chunk_size,
+            segments,
+            write_buffer,
+            fsync,
+        )
+        if result is not None:
+            return result
+
+    offset = 0
+    headers = {}
     if resume and os.path.exists(file):
-        file_size = os.path.getsize(file)
-        range_header = {"Range": f"bytes={file_size}-"}
-        logger.info(f"Trying to resume download from byte {file_size}")
-
-    # does not like when the session is passed. keeps giving 401 Unauthorized
-    with requests.get(url, stream=True, headers=range_header) as r:
-        start = time.time()
-        bar_len = 0
-        prev = (0, start)
+        offset, etag = load_resume_state(file, state_filepath)
+        headers["Range"] = f"bytes={offset}-"
+        # the server sends the whole file instead if it has changed since
+        if etag:
+            headers["If-Range"] = etag
+        logger.info(f"Trying to resume download from byte {offset}")
+
+    # session must be a cdn session without the api Authorization header, see create_cdn_session
+    with session.get(url, stream=True, headers=headers) as r:
+        if r.status_code == 416 and offset:
+            # the partial file is not a prefix of the attachment, the retry starts over
+            remove_file(file)
+            remove_file(state_filepath)
+            return r.status_code, r.reason, None
         if r.status_code != 200 and r.status_code != 206:
-            return r.status_code, r.reason
-
-        downloaded = os.path.getsize(file) if resume and os.path.exists(file) else 0
-        content_length = int(r.headers.get("content-length", 0))
-        total = content_length + downloaded
-
-        local_md5 = calculate_md5(filepath) if os.path.exists(filepath) else None
-        server_md5 = r.headers.get("ETag", "")
-        if local_md5:
-            if server_md5 == f'W/"{local_md5}"' or server_md5 == f'"{local_md5}"':
-                return 1, "File already exists and has correct hash"
-
-            if server_md5 == "" and os.path.getsize(filepath) == total:
-                return (
-                    1,
-                    "File already exists but no server hash was given but content-length matches",
-                )
+            return r.status_code, r.reason, None
+        metrics.increment("cdn_requests", status=r.status_code)
 
-        if temp_file and os.path.exists(filepath):
-            return 1, "File already exists but has incorrect hash"
+        if r.status_code == 200:
+            offset = 0
+        downloaded = offset
+        total = get_total_size(r.headers, offset)
+        etag = r.headers.get("ETag", "")
+        server_md5 = etag_md5(etag)
+
+        if temp_file or not offset:
+            existing = check_existing_file(filepath, total, server_md5, temp_file)
+            if existing:
+                return existing
 
         if simulate:
-            print_download_bar(1, 1, start, prev, bar_len)
-            print()
-            return r.status_code, r.reason
+            return r.status_code, r.reason, None
 
-        if not os.path.exists(file_path):
-            logger.debug("Creating Path because it did not exist")
-            os.makedirs(file_path)
+        ensure_directory(file_path)
         logger.debug(f"Writing response contents to {file}")
-        mode = "ab" if resume and os.path.exists(file) else "wb"
-        with open(file, mode) as f:
-            print(f"[{' '*50}] 0/0 B at 0 B/s ETA 00:00:00", end="\r")
-            for chunk in r.iter_content(chunk_size=8192):
+        hash_md5 = hashlib.md5()
+        if offset:
+            # hash objects can not be saved, so the part that is already on disk is hashed
+            # once here and the rest is hashed while it streams in
+            with metrics.timer("hashing"):
+                update_md5(hash_md5, file, offset)
+        if not offset:
+            # also without resuming, a file at its final path needs the state to not be taken
+            # for a finished one
+            create_file(
+                file,
+                total,
+                partial(save_resume_state, state_filepath, 0, etag)
+                if resume or not temp_file
+                else None,
+            )
+        transfer_start = time.perf_counter()
+        transfer = progress.start_transfer(filename, total, offset) if progress else None
+        writer = BufferedFileWriter(
+            file,
+            offset,
+            write_buffer,
+            fsync,
+            hash_md5,
+            partial(save_resume_state, state_filepath, etag=etag) if resume else None,
+            RESUME_STATE_INTERVAL,
+        )
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
                 downloaded += len(chunk)
-                f.write(chunk)
-                bar_len, prev = print_download_bar(
-                    total, downloaded, start, prev, bar_len
-                )
-        print()
-
-    local_md5 = calculate_md5(file)
-    # if server_md5 != "" and server_md5 != f'"{local_md5}"':
-    #     return (
-    #         2,
-    #         f"File completed with incorrect hash | expected: {server_md5} got: {local_md5}",
-    #     )
-    # if total != downloaded:
-    #     return (
-    #         2,
-    #         f"File completed with incorrect file size | total: {total} downloaded: {downloaded}",
-    #     )
+                writer.write(chunk)
+                # the renderer thread reads this, keeps the loop free of formatting
+                if transfer:
+                    transfer.downloaded += len(chunk)
+        finally:
+            if transfer:
+                progress.finish_transfer(transfer)
+            metrics.add_time("transfer", time.perf_counter() - transfer_start)
+            metrics.increment("bytes_downloaded", downloaded - offset)
+            try:
+                writer.close()
+            finally:
+                if resume:
+                    save_resume_state(state_filepath, writer.position, etag)
 
+    local_md5 = hash_md5.hexdigest()
+    if total and total != downloaded:
+        # keep the partial file, it can be resumed
+        return (
+            2,
+            f"File completed with incorrect file size | total: {total} downloaded: {downloaded}",
+            None,
+        )
+    if server_md5 and server_md5 != local_md5:
+        remove_file(file)
+        remove_file(state_filepath)
+        return (
+            2,
+            f"File completed with incorrect hash | expected: {server_md5} got: {local_md5}",
+            None,
+        )
+
+    remove_file(state_filepath)
     if temp_file:
         os.rename(temp_filepath, filepath)
-    return r.status_code, r.reason
-
-
-def calculate_bytes(bytes: int):
-    if bytes / 2**10 < 100:
-        return (round(bytes / 2**10, 1), "KB")
-    if bytes / 2**20 < 100:
-        return (round(bytes / 2**20, 1), "MB")
-    if bytes / 2**30 < 100:
-        return (round(bytes / 2**30, 1), "GB")
-    if bytes / 2**40 < 100:
-        return (round(bytes / 2**40, 1), "TB")
-
-
-def convert_bytes(bytes: int, size: str):
-    if size == "KB":
-        return round(bytes / 2**10, 1)
-    elif size == "MB":
-        return round(bytes / 2**20, 1)
-    elif size == "GB":
-        return round(bytes / 2**30, 1)
-    elif size == "TB":
-        return round(bytes / 2**40, 1)
-
-
-# this is so messy
-def print_download_bar(total, downloaded, start, prev, bar_len) -> None:
-    now = time.time()
-    td = now - start
-    td2 = now - prev[1]
-    if td < 0.1:
-        return bar_len, prev
-
-    rate, rate_size = calculate_bytes((downloaded) / td)
-
-    progress = 0
-    if total:
-        progress = int(100 * downloaded / total)
-        done = int(50 * downloaded / total)
-        bar_fill = "=" * done
-        bar_empty = " " * (50 - done)
-        total, size = calculate_bytes(total)
-        downloaded = convert_bytes(downloaded, size)
-        eta = "00:00:00"
-        # eta = time.strftime(
-        #     "%H:%M:%S", time.gmtime((total - downloaded) / (downloaded / td))
-        # )
+    return r.status_code, r.reason, local_md5
+
+
+def check_existing_file(filepath: str, total: int, server_md5: str, temp_file: bool):
+    # returns the result for a file that is already at filepath, or None to download it
+    if not os.path.exists(filepath):
+        return None
+    if os.path.exists(filepath + RESUME_STATE_SUFFIX):
+        # a download that did not finish, preallocated to the full size
+        return None
+    local_size = os.path.getsize(filepath)
+    # a file with the wrong size can not have the right hash, so do not read it
+    local_md5 = None
+    if local_size == total or not total:
+        with metrics.timer("hashing"):
+            local_md5 = calculate_md5(filepath)
+    if local_md5 and server_md5 == local_md5:
+        return 1, "File already exists and has correct hash", local_md5
+
+    if local_md5 and not server_md5 and local_size == total:
+        return (
+            1,
+            "File already exists but no server hash was given but content-length matches",
+            local_md5,
+        )
+
+    if temp_file:
+        return 1, "File already exists but has incorrect hash", None
+    return None
+
+
+def download_segmented(
+    session: requests.Session,
+    url: str,
+    filepath: str,
+    temp_file: bool,
+    resume: bool,
+    progress,
+    chunk_size: int,
+    segments: int,
+    write_buffer: int = 0,
+    fsync: str = "none",
+):
+    # downloads byte ranges of the file over separate connections into a preallocated
+    # file. returns None when the server does not support ranges or the HEAD request
+    # failed, so the caller falls back to a single stream
+    file_path, filename = os.path.split(filepath)
+    file = filepath + ".part" if temp_file else filepath
+    state_filepath = file + RESUME_STATE_SUFFIX
+
+    r = session.head(url, allow_redirects=True)
+    metrics.increment("cdn_requests", status=r.status_code)
+    if r.status_code in (403, 404):
+        # an expired url or a deleted file, the caller refreshes the url or gives up
+        return r.status_code, r.reason, None
+    if r.status_code != 200:
+        # some servers do not answer HEAD properly, the GET of the single stream decides
+        logger.debug(f"{r.status_code} {r.reason} HEAD request failed for {filename}, using a single connection")
+        return None
+    total = int(r.headers.get("Content-Length", 0))
+    etag = r.headers.get("ETag", "")
+    if not total or r.headers.get("Accept-Ranges") != "bytes":
+        logger.debug(f"Server does not support ranges for {filename}, using a single connection")
+        return None
+    server_md5 = etag_md5(etag)
+
+    state = None
+    if resume and os.path.exists(file):
+        state = load_segment_state(state_filepath, total, etag)
+    # without temp files a partial segmented download is at filepath, and is not a finished file
+    if not (state and not temp_file):
+        existing = check_existing_file(filepath, total, server_md5, temp_file)
+        if existing:
+            return existing
+
+    ensure_directory(file_path)
+    if state is None:
+        size = -(-total // segments)
+        # [start, committed, end), committed is how far the segment is safely on disk
+        state = {
+            "etag": etag,
+            "total": total,
+            "segments": [[start, start, min(start + size, total)] for start in range(0, total, size)],
+        }
+        create_file(
+            file,
+            total,
+            partial(save_segment_state, state_filepath, state) if resume or not temp_file else None,
+        )
     else:
-        done = 50
-        bar_fill = "?" * done
-        bar_empty = " " * (50 - done)
-        total = "???"
-        downloaded, size = calculate_bytes(downloaded)
-        eta = "00:00:00"
-
-    progress_bar = f"[{bar_fill}{bar_empty}] {downloaded}/{total} {size} at {rate} {rate_size}/s ETA {eta}"
-    overlap = bar_len - len(progress_bar)
-    overlap_buffer = " " * overlap if overlap > 0 else ""
-    # print(f"progress {progress} | prev[0] {prev[0]} | int(td2) {int(td2)}")
-    # should make the amount of time before refreshing a ratio of prev eta and current eta
-    if progress - prev[0] > 2 or (int(td2) > 10 and progress > 1):
-        print(f"{progress_bar}{overlap_buffer}", end="\r")
-        return len(progress_bar), (progress, now)
-    return bar_len, prev
+        logger.info(f"Resuming segmented download of {filename}")
+    ranges = state["segments"]
+    pending = [segment for segment in ranges if segment[1] < segment[2]]
+    logger.debug(f"Downloading {filename} in {len(pending)} of {len(ranges)} segments")
+
+    lock = threading.Lock()
+    # the write buffer is shared by the segments of the file
+    segment_buffer = write_buffer // max(1, len(pending))
+    completed = sum(segment[1] - segment[0] for segment in ranges)
+    transfer = progress.start_transfer(filename, total, completed) if progress else None
+
+    def commit(segment: list, position: int) -> None:
+        with lock:
+            segment[1] = position
+            if resume:
+                save_segment_state(state_filepath, state)
+
+    def fetch_range(segment: list) -> None:
+        headers = {"Range": f"bytes={segment[1]}-{segment[2] - 1}"}
+        # the server sends the whole file instead if it has changed since
+        if etag:
+            headers["If-Range"] = etag
+        with session.get(url, stream=True, headers=headers) as r:
+            metrics.increment("cdn_requests", status=r.status_code)
+            if r.status_code != 206:
+                raise SegmentError(f"{r.status_code} {r.reason}")
+            start = position = segment[1]
+            writer = BufferedFileWriter(
+                file,
+                position,
+                segment_buffer,
+                fsync,
+                checkpoint=partial(commit, segment),
+                checkpoint_interval=RESUME_STATE_INTERVAL,
+            )
+            try:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    chunk = chunk[: segment[2] - position]
+                    writer.write(chunk)
+                    position += len(chunk)
+                    if transfer:
+                        with lock:
+                            transfer.downloaded += len(chunk)
+                    if position >= segment[2]:
+                        break
+            finally:
+                metrics.increment("bytes_downloaded", position - start)
+                try:
+                    writer.close()
+                finally:
+                    commit(segment, writer.position)
+        if position < segment[2]:
+            raise SegmentError(f"connection closed at byte {position} of {segment[2]}")
+
+    def fetch_segment(segment: list) -> None:
+        # a failed segment is retried on its own, the others keep going
+        attempts = 0
+        while True:
+            try:
+                fetch_range(segment)
+                return
+            except (requests.exceptions.RequestException, SegmentError) as e:
+                attempts += 1
+                if attempts > SEGMENT_RETRIES:
+                    raise
+                metrics.increment("retries", kind="segment")
+                logger.debug(
+                    f"Segment {segment[0]}-{segment[2]} of {filename} failed ({e}), retrying ({attempts}/{SEGMENT_RETRIES})"
+                )
+                time.sleep(backoff(attempts - 1, 0.5, 10))
+
+    transfer_start = time.perf_counter()
+    errors = []
+    try:
+        with ThreadPoolExecutor(
+            max_workers=max(1, len(pending)), thread_name_prefix="segment"
+        ) as executor:
+            for future in [executor.submit(fetch_segment, segment) for segment in pending]:
+                try:
+                    future.result()
+                except (requests.exceptions.RequestException, SegmentError) as e:
+                    errors.append(e)
+    finally:
+        if transfer:
+            progress.finish_transfer(transfer)
+        metrics.add_time("transfer", time.perf_counter() - transfer_start)
+    if errors:
+        # the finished segments are kept when resuming
+        if not resume:
+            remove_file(file)
+            remove_file(state_filepath)
+        return 2, f"{len(errors)} segments failed, last error: {errors[-1]}", None
+
+    # segments arrive out of order, so the file is hashed once it is complete
+    hash_md5 = hashlib.md5()
+    with metrics.timer("hashing"):
+        update_md5(hash_md5, file, total)
+    local_md5 = hash_md5.hexdigest()
+    if server_md5 and server_md5 != local_md5:
+        remove_file(file)
+        remove_file(state_filepath)
+        return (
+            2,
+            f"File completed with incorrect hash | expected: {server_md5} got: {local_md5}",
+            None,
+        )
+
+    remove_file(state_filepath)
+    if temp_file:
+        os.rename(file, filepath)
+    return 200, "OK", local_md5
+
+
+def create_file(file: str, size: int, save_state=None) -> None:
+    # saves the resume state, then preallocates file. a preallocated file without resume
+    # state would look complete, so the state goes first
+    try:
+        if save_state:
+            save_state()
+        preallocate(file, size)
+    except FileNotFoundError:
+        # the directory was removed after it was created, e.g. the output of a service
+        # job was moved away, so the cache of created directories is out of date
+        ensure_directory(os.path.dirname(file), refresh=True)
+        if save_state:
+            save_state()
+        preallocate(file, size)
+
+
+def preallocate(file: str, size: int) -> None:
+    # reserves the whole file up front, so it is not fragmented by growing chunk by chunk
+    with open(file, "wb") as f:
+        if not size:
+            return
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                # not every filesystem supports it
+                pass
+        f.truncate(size)
+
+
+def load_segment_state(state_filepath: str, total: int, etag: str):
+    try:
+        with open(state_filepath, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if "segments" not in state or state.get("total") != total or state.get("etag") != etag:
+        # not a segmented download, or the file changed on the server
+        return None
+    return state
+
+
+def save_segment_state(state_filepath: str, state: dict) -> None:
+    with open(state_filepath, "w") as f:
+        json.dump(state, f)
+
+
+def ensure_directory(path: str, refresh: bool = False) -> None:
+    # most attachments go to a handful of directories, so only the first file in each
+    # one pays for the makedirs call
+    if path in created_directories and not refresh:
+        return
+    logger.debug(f"Creating path {path}")
+    os.makedirs(path, exist_ok=True)
+    created_directories.add(path)
+
+
+def forget_directories() -> None:
+    # directories can be removed between runs of the same process
+    created_directories.clear()
+
+
+def get_total_size(headers, offset: int) -> int:
+    # Content-Range: bytes 100-199/200
+    content_range = headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("*"):
+        return int(content_range.rsplit("/", 1)[1])
+    content_length = int(headers.get("content-length", 0))
+    return content_length + offset if content_length else 0
+
+
+def load_resume_state(file: str, state_filepath: str) -> tuple[int, str]:
+    # returns the byte offset to resume from and the ETag of the partial download
+    file_size = os.path.getsize(file)
+    try:
+        with open(state_filepath, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return file_size, None
+    offset = state.get("offset", 0)
+    if offset > file_size:
+        return file_size, None
+    if offset < file_size:
+        # bytes written after the last saved state may be incomplete
+        with open(file, "r+b") as f:
+            f.truncate(offset)
+    return offset, state.get("etag") or None
+
+
+def save_resume_state(state_filepath: str, offset: int, etag: str) -> None:
+    with open(state_filepath, "w") as f:
+        json.dump({"offset": offset, "etag": etag}, f)
+
+
+def remove_file(file: str) -> None:
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
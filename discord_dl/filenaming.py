@@ -1,21 +1,37 @@
 import os
 import re
 import pathlib
+from functools import lru_cache
+from string import Formatter
 
-from utils import convert_discord_timestamp
+from utils import snowflake_to_datetime
 
 
-def create_format_variables(message: dict, attachment: dict, index: int = 0) -> dict:
-    variables = {
-        "filename": os.path.splitext(attachment["filename"])[0],
-        "ext": os.path.splitext(attachment["filename"])[1][1:],
+def create_message_variables(message: dict) -> dict:
+    # the same for every attachment of a message, so it is only built once per message
+    return {
         "message_id": message["id"],
-        "id": attachment["id"],
-        "date": convert_discord_timestamp(message["timestamp"]),
+        # the snowflake holds the creation time, which is cheaper than parsing the timestamp
+        "date": snowflake_to_datetime(message["id"]),
         "username": message["author"]["username"],
         "user_id": message["author"]["id"],
     }
-    return variables
+
+
+def create_attachment_variables(attachment: dict) -> dict:
+    filename, ext = os.path.splitext(attachment["filename"])
+    return {
+        "filename": filename,
+        "ext": ext[1:],
+        "id": attachment["id"],
+    }
+
+
+def create_format_variables(message: dict, attachment: dict, index: int = 0) -> dict:
+    return {
+        **create_attachment_variables(attachment),
+        **create_message_variables(message),
+    }
 
 def truncate_filename(filename):
     MAX_FILENAME_LENGTH = 200
@@ -35,6 +51,57 @@ def truncate_filename(filename):
     else:
         return filename
 
+# control characters are removed and path separators replaced in every component
+BASE_TRANSLATION = {**{i: None for i in range(0x20)}, ord("/"): "_"}
+WINDOWS_TRANSLATION = {**BASE_TRANSLATION, **{ord(c): "_" for c in '<>:"/\\|?*'}}
+RESTRICTED_PATTERN = re.compile(r"[^\x21-\x7f]")
+
+
+class PathTemplate:
+    # splits a format template into path components once, components without
+    # format fields are sanitized here instead of for every file
+    def __init__(self, template: str, win_filenames: bool, restrict_filenames: bool) -> None:
+        self.windows = os.name == "nt" or win_filenames
+        self.restrict = restrict_filenames
+        self.translation = WINDOWS_TRANSLATION if self.windows else BASE_TRANSLATION
+        components = []
+        while template:
+            template, tail = os.path.split(template)
+            components.insert(0, tail)
+        self.components = []
+        for index, component in enumerate(components):
+            is_filename = index == len(components) - 1
+            has_fields = any(field is not None for _, field, _, _ in Formatter().parse(component))
+            if not has_fields:
+                component = self.sanitize(component.format(), is_filename)
+            self.components.append((component, has_fields, is_filename))
+
+    def sanitize(self, string: str, is_filename: bool) -> str:
+        string = string.translate(self.translation)
+        if self.restrict:
+            string = RESTRICTED_PATTERN.sub("_", string)
+        # windows folder names can not end with spaces (" ") or periods (".")
+        if self.windows and not is_filename:
+            string = string.strip(" .")
+        return string
+
+    def render(self, path: str, variables: dict) -> str:
+        components = [
+            self.sanitize(component.format_map(variables), is_filename)
+            if has_fields
+            else component
+            for component, has_fields, is_filename in self.components
+        ]
+        filepath = os.path.join(path, *components)
+        file_path, filename = os.path.split(filepath)
+        return file_path + os.path.sep + truncate_filename(filename)
+
+
+@lru_cache(maxsize=None)
+def compile_template(template: str, win_filenames: bool, restrict_filenames: bool) -> PathTemplate:
+    return PathTemplate(template, win_filenames, restrict_filenames)
+
+
 def create_filepath(
     variables: dict,
     path: str,
@@ -46,46 +113,13 @@ def create_filepath(
     format_template = (
         channel_format_template if "server_id" in variables else dm_format_template
     )
-    components = []
-    first = True
-    while format_template:
-        head, tail = os.path.split(format_template)
-        if first:
-            components.insert(
-                0,
-                sanitize_filename(
-                    tail.format(**variables), win_filenames, restrict_filenames
-                ),
-            )
-            first = False
-        else:
-            components.insert(
-                0,
-                sanitize_foldername(
-                    tail.format(**variables), win_filenames, restrict_filenames
-                ),
-            )
-        format_template = head
-    components.insert(0, path)
-    filepath = os.path.join(*components)
-
-    file_path, filename = os.path.split(filepath)
+    template = compile_template(format_template, win_filenames, restrict_filenames)
+    return template.render(path, variables)
 
-    return file_path + os.path.sep + truncate_filename(filename)
 
 def sanitize_filename(string, windows_naming, restrict_filenames):
-    string = re.sub(r"[/]", "_", string)
-    string = re.sub(r"[\x00-\x1f]", "", string)
-    if os.name == "nt" or windows_naming:
-        string = re.sub(r"[<>:\"/\\\|\?\*]", "_", string)
-    if restrict_filenames:
-        string = re.sub(r"[^\x21-\x7f]", "_", string)
-    return string
+    return compile_template("", windows_naming, restrict_filenames).sanitize(string, True)
 
 
 def sanitize_foldername(string, windows_naming, restrict_filenames):
-    string = sanitize_filename(string, windows_naming, restrict_filenames)
-    # windows folder names can not end with spaces (" ") or periods (".")
-    if os.name == "nt" or windows_naming:
-        string = string.strip(" .")
-    return string
+    return compile_template("", windows_naming, restrict_filenames).sanitize(string, False)
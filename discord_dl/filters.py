@@ -0,0 +1,184 @@
+import logging
+import mimetypes
+import os
+import re
+
+from logger import logger
+from metrics import metrics
+from utils import snowflake_to_datetime
+
+
+class AttachmentFilter:
+    # every option is turned into a (description, predicate) pair once, so checking a
+    # message or attachment is just calling the predicates that are actually in use
+    def __init__(self, options: dict) -> None:
+        self.message_checks = []
+        self.attachment_checks = []
+        self.compile_message_checks(options)
+        self.compile_attachment_checks(options)
+        # checked once, so rejected messages do not build log lines nobody sees
+        self.debug = logger.isEnabledFor(logging.DEBUG)
+
+    def compile_message_checks(self, options: dict) -> None:
+        date = options.get("date")
+        date_before = options.get("date_before")
+        date_after = options.get("date_after")
+        if date or date_before or date_after:
+
+            def check_date(message: dict) -> bool:
+                message_date = snowflake_to_datetime(message["id"]).replace(
+                    hour=0, minute=0, second=0, microsecond=0, tzinfo=None
+                )
+                return (
+                    (not date or message_date == date)
+                    and (not date_before or message_date < date_before)
+                    and (not date_after or message_date > date_after)
+                )
+
+            self.message_checks.append(("date", check_date))
+
+        usernames = frozenset(options.get("username") or ())
+        if usernames:
+            self.message_checks.append(
+                (
+                    f"username not in {sorted(usernames)}",
+                    lambda message: message["author"]["username"] in usernames,
+                )
+            )
+
+        user_ids = frozenset(options.get("user_id") or ())
+        if user_ids:
+            self.message_checks.append(
+                (
+                    f"user id not in {sorted(user_ids)}",
+                    lambda message: message["author"]["id"] in user_ids,
+                )
+            )
+
+        if options.get("content_regex"):
+            content = re.compile(options["content_regex"])
+            self.message_checks.append(
+                (
+                    f"content does not match {content.pattern!r}",
+                    lambda message: content.search(message.get("content") or "") is not None,
+                )
+            )
+
+    def compile_attachment_checks(self, options: dict) -> None:
+        extensions = normalize_extensions(options.get("ext"))
+        if extensions:
+            self.attachment_checks.append(
+                (
+                    f"extension not in {sorted(extensions)}",
+                    lambda attachment: attachment_extension(attachment) in extensions,
+                )
+            )
+
+        excluded_extensions = normalize_extensions(options.get("exclude_ext"))
+        if excluded_extensions:
+            self.attachment_checks.append(
+                (
+                    f"extension in {sorted(excluded_extensions)}",
+                    lambda attachment: attachment_extension(attachment)
+                    not in excluded_extensions,
+                )
+            )
+
+        content_types = compile_content_types(options.get("content_type"))
+        if content_types:
+            self.attachment_checks.append(
+                (
+                    f"content type not in {options['content_type']}",
+                    lambda attachment: match_content_type(attachment, content_types),
+                )
+            )
+
+        excluded_content_types = compile_content_types(options.get("exclude_content_type"))
+        if excluded_content_types:
+            self.attachment_checks.append(
+                (
+                    f"content type in {options['exclude_content_type']}",
+                    lambda attachment: not match_content_type(
+                        attachment, excluded_content_types
+                    ),
+                )
+            )
+
+        min_size = options.get("min_size")
+        if min_size:
+            self.attachment_checks.append(
+                (
+                    f"size < {min_size}",
+                    lambda attachment: attachment.get("size", 0) >= min_size,
+                )
+            )
+
+        max_size = options.get("max_size")
+        if max_size:
+            self.attachment_checks.append(
+                (
+                    f"size > {max_size}",
+                    lambda attachment: attachment.get("size", 0) <= max_size,
+                )
+            )
+
+        if options.get("filename_regex"):
+            filename = re.compile(options["filename_regex"])
+            self.attachment_checks.append(
+                (
+                    f"filename does not match {filename.pattern!r}",
+                    lambda attachment: filename.search(attachment["filename"]) is not None,
+                )
+            )
+
+    def match_message(self, message: dict) -> bool:
+        for description, check in self.message_checks:
+            if not check(message):
+                if self.debug:
+                    logger.debug(f"Skipping message id {message['id']}, {description}")
+                return False
+        return True
+
+    def match_attachment(self, attachment: dict) -> bool:
+        for description, check in self.attachment_checks:
+            if not check(attachment):
+                if self.debug:
+                    logger.debug(f"Skipping attachment {attachment['filename']}, {description}")
+                metrics.increment("files", result="filtered")
+                return False
+        return True
+
+
+def normalize_extensions(extensions: list) -> frozenset:
+    return frozenset(ext.strip().lstrip(".").lower() for ext in extensions or () if ext.strip())
+
+
+def attachment_extension(attachment: dict) -> str:
+    return os.path.splitext(attachment["filename"])[1][1:].lower()
+
+
+def compile_content_types(content_types: list) -> tuple:
+    # "video/*" matches every video type, anything else has to match exactly
+    exact = set()
+    prefixes = []
+    for content_type in content_types or ():
+        content_type = content_type.strip().lower()
+        if content_type.endswith("/*"):
+            prefixes.append(content_type[:-1])
+        elif content_type:
+            exact.add(content_type)
+    if not exact and not prefixes:
+        return ()
+    return frozenset(exact), tuple(prefixes)
+
+
+def match_content_type(attachment: dict, content_types: tuple) -> bool:
+    exact, prefixes = content_types
+    content_type = attachment.get("content_type") or mimetypes.guess_type(
+        attachment["filename"]
+    )[0]
+    if not content_type:
+        return False
+    # drop parameters like "; charset=utf-8"
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    return content_type in exact or content_type.startswith(prefixes)
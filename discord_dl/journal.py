@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from logger import logger
+
+JOURNAL_FILENAME = ".discord_dl.journal"
+
+
+class RunJournal:
+    # an append-only log of the current run, one json record per line:
+    #   run      the channels the run was started with
+    #   page     a channel page was queued, cursor is where pagination continues from
+    #   queued   an attachment was queued for download
+    #   done     an attachment is on disk
+    #   channel  every page of a channel was queued
+    # records are written in order, so whatever survives a crash is a consistent prefix
+    def __init__(
+        self,
+        path: str,
+        resume: bool = False,
+        require_run: bool = False,
+        sync_interval: float = 1.0,
+        sync_records: int = 1000,
+    ) -> None:
+        self.journal_path = os.path.join(path, JOURNAL_FILENAME)
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self.lock = threading.Lock()
+        self.channel_ids = []
+        # channel id -> {"cursor", "seen", "newest", "done"}
+        self.channels = {}
+        # channel id -> attachment id -> (message, attachment), in the order they were queued
+        self.pending = {}
+        if resume:
+            self.load()
+            # without channels there is nothing to resume, and the empty run would be
+            # taken for a finished one and its journal removed
+            if require_run and not self.channel_ids:
+                raise RuntimeError(
+                    f"No interrupted run to resume in {path}, give the channels to start a new run"
+                )
+        # the replayed state is written to a new journal so it does not grow with every resume
+        temp_path = f"{self.journal_path}.tmp"
+        with open(temp_path, "w") as f:
+            for record in self.snapshot():
+                f.write(encode(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.journal_path)
+        self.file = open(self.journal_path, "a")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def load(self) -> None:
+        if not os.path.exists(self.journal_path):
+            logger.info("No interrupted run to resume, starting a new one")
+            return
+        records = 0
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line is cut off when the process died while writing it
+                    logger.debug(f"Ignoring incomplete journal record: {line!r}")
+                    break
+                self.apply(record)
+                records += 1
+        pending = sum(len(attachments) for attachments in self.pending.values())
+        logger.info(
+            f"Resuming run from {records} journal records, {len(self.channels)} channels "
+            f"and {pending} queued attachments"
+        )
+
+    def apply(self, record: dict) -> None:
+        kind = record["t"]
+        if kind == "run":
+            self.channel_ids = record["channels"]
+            return
+        channel_id = record["c"]
+        if kind == "page":
+            channel = self.channels.setdefault(channel_id, {})
+            channel.update(
+                cursor=record["cursor"], seen=record["seen"], newest=record["newest"]
+            )
+        elif kind == "queued":
+            attachment = record["a"]
+            self.pending.setdefault(channel_id, OrderedDict())[attachment["id"]] = (
+                record["m"],
+                attachment,
+            )
+        elif kind == "done":
+            self.pending.get(channel_id, {}).pop(record["a"], None)
+        elif kind == "channel":
+            self.channels.setdefault(channel_id, {})["done"] = True
+
+    def snapshot(self) -> list:
+        records = []
+        if self.channel_ids:
+            records.append({"t": "run", "channels": self.channel_ids})
+        for channel_id, channel in self.channels.items():
+            if "cursor" in channel:
+                records.append(
+                    {
+                        "t": "page",
+                        "c": channel_id,
+                        "cursor": channel["cursor"],
+                        "seen": channel["seen"],
+                        "newest": channel["newest"],
+                    }
+                )
+            if channel.get("done"):
+                records.append({"t": "channel", "c": channel_id})
+        for channel_id, attachments in self.pending.items():
+            for message, attachment in attachments.values():
+                records.append({"t": "queued", "c": channel_id, "m": message, "a": attachment})
+        return records
+
+    def append(self, record: dict) -> None:
+        line = encode(record)
+        sync = False
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line)
+            # every record reaches the operating system right away, so it survives the
+            # process being killed. only the fsync for a system crash is batched
+            self.file.flush()
+            self.apply(record)
+            self.unsynced += 1
+            now = time.monotonic()
+            # fsync is what makes appends slow, so it is batched by count and time
+            if self.unsynced >= self.sync_records or now - self.last_sync >= self.sync_interval:
+                fileno = self.file.fileno()
+                self.unsynced = 0
+                self.last_sync = now
+                sync = True
+        if sync:
+            os.fsync(fileno)
+
+    def start_run(self, channel_ids: list) -> None:
+        self.append({"t": "run", "channels": channel_ids})
+
+    def page_queued(self, channel_id: str, cursor: str, seen: int, newest: str) -> None:
+        self.append(
+            {"t": "page", "c": channel_id, "cursor": cursor, "seen": seen, "newest": newest}
+        )
+
+    def attachment_queued(self, channel_id: str, message: dict, attachment: dict) -> None:
+        # only what is needed to queue the attachment again
+        message = {
+            "id": message["id"],
+            "author": {
+                "id": message["author"]["id"],
+                "username": message["author"]["username"],
+            },
+        }
+        self.append({"t": "queued", "c": channel_id, "m": message, "a": attachment})
+
+    def attachment_done(self, channel_id: str, attachment_id: str) -> None:
+        self.append({"t": "done", "c": channel_id, "a": attachment_id})
+
+    def channel_done(self, channel_id: str) -> None:
+        self.append({"t": "channel", "c": channel_id})
+
+    def get_channel(self, channel_id: str) -> dict:
+        with self.lock:
+            return dict(self.channels.get(channel_id, {}))
+
+    def get_pending(self, channel_id: str) -> list:
+        # the attachments of channel_id that were queued but never finished, grouped
+        # back into messages
+        with self.lock:
+            attachments = list(self.pending.get(channel_id, {}).values())
+        messages = OrderedDict()
+        for message, attachment in attachments:
+            entry = messages.setdefault(message["id"], {**message, "attachments": []})
+            entry["attachments"].append(attachment)
+        return list(messages.values())
+
+    def is_finished(self) -> bool:
+        with self.lock:
+            return all(
+                self.channels.get(channel_id, {}).get("done")
+                for channel_id in self.channel_ids
+            ) and not any(self.pending.values())
+
+    def close(self) -> None:
+        # the journal is only kept while there is something left to resume
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+        if self.is_finished():
+            os.remove(self.journal_path)
+        else:
+            logger.info("The run did not finish, continue it with --resume-run")
+
+
+def encode(record: dict) -> str:
+    return json.dumps(record, separators=(",", ":")) + "\n"
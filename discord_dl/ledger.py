@@ -0,0 +1,262 @@
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from logger import logger
+
+# how long a channel stays claimed by a process that stopped renewing it
+LEASE_SECONDS = 60.0
+# how often a process without a channel to claim checks for leases that ran out
+POLL_INTERVAL = 5.0
+# a channel that failed this many times is given up on for the run
+MAX_CHANNEL_FAILURES = 3
+
+
+class ChannelLedger:
+    # shares the channels of a run between processes using the same download path. each
+    # channel is leased by one process at a time, the lease is renewed while the process is
+    # alive and taken over by another process once it runs out, so the channels of a
+    # crashed process are picked up. a channel is done once it was paged through and every
+    # attachment queued from it was handled. once no channel is pending the ledger belongs
+    # to a finished run and is cleared
+    def __init__(
+        self,
+        db_path: str,
+        channel_ids: list,
+        lease_seconds: float = LEASE_SECONDS,
+        poll_interval: float = POLL_INTERVAL,
+    ) -> None:
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        # shared by the channel workers, every access goes through self.lock. transactions
+        # are started by hand, so they can take the write lock before reading
+        self.connection = sqlite3.connect(
+            db_path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        # readers and the writer of other processes do not block each other
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.transaction() as connection:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS ledger (
+                    channel_id TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    owner TEXT,
+                    lease_until REAL NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            connection.execute(
+                "DELETE FROM ledger WHERE NOT EXISTS (SELECT 1 FROM ledger WHERE status = 'pending')"
+            )
+            start = connection.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM ledger").fetchone()[0]
+            # processes started with other channels add theirs to the run
+            connection.executemany(
+                "INSERT OR IGNORE INTO ledger (channel_id, position, status) VALUES (?, ?, 'pending')",
+                [(channel_id, start + i) for i, channel_id in enumerate(channel_ids)],
+            )
+        # channel id -> [attachments queued and not handled yet, paged through]
+        self.channels = {}
+        self.completed = 0
+        self.channels_lock = threading.Lock()
+        # when the leases were last renewed, after lease_seconds without a renewal other
+        # processes may take the channels over
+        self.renewed = time.time()
+        self.stop_event = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_leases, name="ledger", daemon=True)
+        self.heartbeat.start()
+        logger.info(f"Sharing channels through the ledger as {self.owner}")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def claim(self, stop_event: threading.Event):
+        # returns the next channel to download, or None once every channel is done. while
+        # other processes hold the remaining channels this waits, in case one of them dies
+        while not stop_event.is_set():
+            now = time.time()
+            with self.transaction() as connection:
+                row = connection.execute(
+                    """SELECT channel_id, owner FROM ledger
+                    WHERE status = 'pending' AND (owner IS NULL OR lease_until < ?)
+                    ORDER BY position LIMIT 1""",
+                    (now,),
+                ).fetchone()
+                if row:
+                    connection.execute(
+                        "UPDATE ledger SET owner = ?, lease_until = ? WHERE channel_id = ?",
+                        (self.owner, now + self.lease_seconds, row[0]),
+                    )
+                else:
+                    waiting = connection.execute(
+                        """SELECT COUNT(*) FROM ledger
+                        WHERE status = 'pending' AND owner IS NOT NULL AND owner != ?""",
+                        (self.owner,),
+                    ).fetchone()[0]
+            if row:
+                if row[1] and row[1] != self.owner:
+                    logger.warning(f"Taking over channel id {row[0]} from {row[1]}, its lease ran out")
+                with self.channels_lock:
+                    self.channels[row[0]] = [0, False]
+                return row[0]
+            if not waiting:
+                return None
+            logger.debug(f"Waiting for {waiting} channels other processes are downloading")
+            stop_event.wait(self.poll_interval)
+        return None
+
+    def renew_leases(self) -> None:
+        while not self.stop_event.wait(self.lease_seconds / 3):
+            now = time.time()
+            try:
+                with self.transaction() as connection:
+                    connection.execute(
+                        "UPDATE ledger SET lease_until = ? WHERE owner = ? AND status = 'pending'",
+                        (now + self.lease_seconds, self.owner),
+                    )
+                    held = {
+                        row[0]
+                        for row in connection.execute(
+                            "SELECT channel_id FROM ledger WHERE owner = ? AND status = 'pending'",
+                            (self.owner,),
+                        )
+                    }
+            except sqlite3.Error as e:
+                # tried again on the next beat, holds stops the work once the leases ran out
+                logger.warning(f"Failed to renew the channel leases: {e}")
+                continue
+            self.renewed = now
+            with self.channels_lock:
+                lost = [channel_id for channel_id in self.channels if channel_id not in held]
+                for channel_id in lost:
+                    del self.channels[channel_id]
+            for channel_id in lost:
+                logger.warning(f"Another process took over channel id {channel_id}, stopping it")
+
+    def holds(self, channel_id: str) -> bool:
+        # false once another process took the channel over, or could have because the
+        # lease was not renewed in time
+        with self.channels_lock:
+            if channel_id not in self.channels:
+                return False
+        return time.time() < self.renewed + self.lease_seconds
+
+    def attachments_queued(self, channel_id: str, count: int) -> None:
+        with self.channels_lock:
+            if channel_id in self.channels:
+                self.channels[channel_id][0] += count
+
+    def attachment_done(self, channel_id: str) -> None:
+        with self.channels_lock:
+            if channel_id in self.channels:
+                self.channels[channel_id][0] -= 1
+        self.complete_if_done(channel_id)
+
+    def channel_paged(self, channel_id: str) -> None:
+        with self.channels_lock:
+            if channel_id in self.channels:
+                self.channels[channel_id][1] = True
+        self.complete_if_done(channel_id)
+
+    def complete_if_done(self, channel_id: str) -> None:
+        with self.channels_lock:
+            channel = self.channels.get(channel_id)
+            if channel is None or channel[0] > 0 or not channel[1]:
+                return
+            del self.channels[channel_id]
+            self.completed += 1
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE ledger SET status = 'done', owner = NULL WHERE channel_id = ? AND owner = ?",
+                (channel_id, self.owner),
+            )
+
+    def release(self, channel_id: str) -> None:
+        # hands back a channel this process stopped paging, so the heartbeat does not keep
+        # renewing it. a channel another process took over is left alone
+        with self.channels_lock:
+            self.channels.pop(channel_id, None)
+        with self.transaction() as connection:
+            connection.execute(
+                """UPDATE ledger SET owner = NULL, lease_until = 0
+                WHERE channel_id = ? AND owner = ? AND status = 'pending'""",
+                (channel_id, self.owner),
+            )
+
+    def channel_failed(self, channel_id: str) -> None:
+        # the channel goes back to the ledger, so another process or worker tries it again
+        with self.channels_lock:
+            self.channels.pop(channel_id, None)
+        with self.transaction() as connection:
+            connection.execute(
+                """UPDATE ledger SET failures = failures + 1, owner = NULL, lease_until = 0,
+                status = CASE WHEN failures + 1 >= ? THEN 'failed' ELSE 'pending' END
+                WHERE channel_id = ?""",
+                (MAX_CHANNEL_FAILURES, channel_id),
+            )
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.heartbeat.join()
+        with self.transaction() as connection:
+            # unfinished channels of an interrupted process can be claimed right away
+            connection.execute(
+                "UPDATE ledger SET owner = NULL, lease_until = 0 WHERE owner = ? AND status = 'pending'",
+                (self.owner,),
+            )
+            counts = dict(
+                connection.execute("SELECT status, COUNT(*) FROM ledger GROUP BY status").fetchall()
+            )
+            if not counts.get("pending"):
+                connection.execute("DELETE FROM ledger")
+        logger.info(f"Finished {self.completed} channels from the ledger")
+        if counts.get("pending"):
+            logger.info(f"{counts['pending']} channels are left for the other processes or the next run")
+        elif counts.get("failed"):
+            logger.warning(f"Gave up on {counts['failed']} channels that failed {MAX_CHANNEL_FAILURES} times")
+        with self.lock:
+            self.connection.close()
+
+
+def run_processes(count: int, argv: list) -> int:
+    # starts count copies of this command that share the channels through the ledger and
+    # waits for them. returns the highest exit code
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--processes":
+            skip = True
+        elif not arg.startswith("--processes="):
+            args.append(arg)
+    # several progress displays on one terminal would draw over each other
+    args += ["--ledger", "--no-progress"]
+    logger.info(f"Starting {count} processes")
+    children = [subprocess.Popen([sys.executable, sys.argv[0], *args]) for _ in range(count)]
+    returncode = 0
+    for child in children:
+        while True:
+            try:
+                returncode = max(returncode, child.wait())
+                break
+            except KeyboardInterrupt:
+                # Ctrl-C reaches the children too, they finish their in-flight downloads
+                logger.info("Waiting for the processes to stop")
+    return returncode
@@ -1,16 +1,16 @@
 import logging
 
-from arguments import get_args
-
-args = get_args()
 logger = logging.getLogger("discord_dl")
-
-logging_level = logging.WARNING if args.quiet else logging.INFO
-logging_level = logging.DEBUG if args.verbose else logging_level
-logger.setLevel(logging_level)
+logger.setLevel(logging.INFO)
 
 formatter = logging.Formatter("%(levelname)s: %(message)s")
 
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
 logger.addHandler(stream_handler)
+
+
+def set_log_level(verbose: bool = False, quiet: bool = False) -> None:
+    logging_level = logging.WARNING if quiet else logging.INFO
+    logging_level = logging.DEBUG if verbose else logging_level
+    logger.setLevel(logging_level)
@@ -0,0 +1,140 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from logger import logger
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reporter = None
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            # (name, labels) -> value, labels is a sorted tuple of (key, value) pairs
+            self.counters = defaultdict(int)
+            # phase -> seconds, summed over every thread that spent time in it
+            self.timers = defaultdict(float)
+            self.start_time = time.time()
+
+    def increment(self, name: str, value: int = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.timers[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def get(self, name: str, **labels) -> int:
+        # the sum of every counter with this name that matches the given labels
+        with self.lock:
+            return sum(
+                value
+                for (key, key_labels), value in self.counters.items()
+                if key == name and set(labels.items()) <= set(key_labels)
+            )
+
+    def summary(self) -> dict:
+        with self.lock:
+            counters = defaultdict(dict)
+            for (name, labels), value in sorted(self.counters.items()):
+                label = ",".join(f"{k}={v}" for k, v in labels) or "total"
+                counters[name][label] = value
+            return {
+                "elapsed_seconds": round(time.time() - self.start_time, 3),
+                "counters": dict(counters),
+                "phase_seconds": {
+                    phase: round(seconds, 3) for phase, seconds in sorted(self.timers.items())
+                },
+            }
+
+    def stats_line(self) -> str:
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        downloaded = self.get("bytes_downloaded")
+        return (
+            f"{self.get('api_requests')} api requests ({self.get('rate_limited')} rate limited) | "
+            f"{self.get('files', result='downloaded')} downloaded, "
+            f"{self.get('files', result='skipped')} skipped, "
+            f"{self.get('files', result='failed')} failed | "
+            f"{downloaded / 2**20:.1f} MB at {downloaded / 2**20 / elapsed:.2f} MB/s | "
+            f"{self.get('retries')} retries"
+        )
+
+    def write_json(self, path: str) -> None:
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        # node_exporter textfile collector format
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                metric = f"discord_dl_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (key, labels), value in sorted(self.counters.items()):
+                    if key != name:
+                        continue
+                    label = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels)
+                    lines.append(f"{metric}{{{label}}} {value}" if label else f"{metric} {value}")
+            lines.append("# TYPE discord_dl_phase_seconds_total counter")
+            for phase, seconds in sorted(self.timers.items()):
+                lines.append(f'discord_dl_phase_seconds_total{{phase="{phase}"}} {seconds:.6f}')
+            lines.append("# TYPE discord_dl_start_time_seconds gauge")
+            lines.append(f"discord_dl_start_time_seconds {self.start_time:.3f}")
+        write_atomic(path, "\n".join(lines) + "\n")
+
+    def start_reporter(self, interval: float, prometheus_path: str = None) -> None:
+        # logs a stats line, and refreshes the prometheus textfile, every interval seconds
+        if interval <= 0 or self.reporter:
+            return
+        stop_event = threading.Event()
+
+        def report():
+            while not stop_event.wait(interval):
+                logger.info(self.stats_line())
+                if prometheus_path:
+                    self.write_prometheus(prometheus_path)
+
+        thread = threading.Thread(target=report, name="metrics-reporter", daemon=True)
+        thread.start()
+        self.reporter = (thread, stop_event)
+
+    def stop_reporter(self) -> None:
+        if self.reporter:
+            self.reporter[1].set()
+            self.reporter = None
+
+
+def endpoint_name(path: str) -> str:
+    # /api/v9/channels/1234/messages -> /channels/{id}/messages
+    path = re.sub(r"^/api/v\d+", "", path)
+    return re.sub(r"/\d+", "/{id}", path)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_atomic(path: str, content: str) -> None:
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+metrics = Metrics()
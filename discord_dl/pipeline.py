@@ -0,0 +1,204 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+from logger import logger
+from metrics import metrics
+
+
+def join_threads(threads: list) -> None:
+    # join with a timeout so the main thread stays responsive to Ctrl-C
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+
+
+class FairQueue:
+    def __init__(self, maxsize_per_key: int) -> None:
+        # one bounded queue per key (channel), get() takes from the keys in turn so a
+        # large channel can not starve the others
+        self.maxsize_per_key = maxsize_per_key
+        self.queues = OrderedDict()
+        self.condition = threading.Condition()
+
+    def put(self, key, item, timeout: float = None) -> None:
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: len(self.queues.get(key, ())) < self.maxsize_per_key, timeout
+            ):
+                raise queue.Full
+            self.queues.setdefault(key, deque()).append(item)
+            self.condition.notify_all()
+
+    def get(self, timeout: float = None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.queues, timeout):
+                raise queue.Empty
+            key, items = self.queues.popitem(last=False)
+            item = items.popleft()
+            # move the key to the back of the line
+            if items:
+                self.queues[key] = items
+            self.condition.notify_all()
+            return item
+
+    def clear(self) -> None:
+        with self.condition:
+            self.queues.clear()
+            self.condition.notify_all()
+
+
+class DownloadPipeline:
+    def __init__(self, worker, workers: int = 1, queue_size: int = 0, pause=None) -> None:
+        # worker(job) is called from the worker threads and must return one of
+        # "downloaded", "skipped" or "failed"
+        self.worker = worker
+        self.workers = max(1, workers)
+        self.pause = pause
+        self.queue = FairQueue(queue_size or self.workers * 8)
+        self.stop_event = threading.Event()
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.summary = {"downloaded": 0, "skipped": 0, "failed": 0}
+        self.start_time = None
+
+    def start(self) -> None:
+        self.start_time = time.time()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"download-worker-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        logger.debug(f"Started {self.workers} download workers")
+
+    def put(self, job, key=None) -> bool:
+        # block while the channel's queue is full so pagination never runs far ahead of
+        # the downloads
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(key, job, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reopen(self) -> None:
+        # starts the workers again after close, the summary and start time are kept
+        start_time = self.start_time
+        self.closed.clear()
+        self.threads = []
+        self.start()
+        self.start_time = start_time
+
+    def close(self) -> None:
+        # the workers exit once the remaining jobs are done
+        self.closed.set()
+        join_threads(self.threads)
+
+    def abort(self) -> None:
+        logger.warning(
+            "Interrupted, finishing in-flight downloads. Press Ctrl-C again to exit immediately"
+        )
+        self.stop_event.set()
+        self.queue.clear()
+        try:
+            join_threads(self.threads)
+        except KeyboardInterrupt:
+            logger.warning("Exiting without waiting for in-flight downloads")
+
+    def _work(self) -> None:
+        first = True
+        while not self.stop_event.is_set():
+            try:
+                job = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.closed.is_set():
+                    return
+                continue
+            if not first and self.pause:
+                self.pause()
+            first = False
+            try:
+                result = self.worker(job)
+            except Exception:
+                logger.exception("Unhandled error in download worker")
+                result = "failed"
+            with self.lock:
+                self.summary[result] = self.summary.get(result, 0) + 1
+            metrics.increment("files", result=result)
+
+    def log_summary(self) -> None:
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        message = (
+            f"Downloaded {self.summary['downloaded']}, skipped {self.summary['skipped']}, "
+            f"failed {self.summary['failed']} attachments in {elapsed:.1f} seconds"
+        )
+        if self.summary.get("released"):
+            # their channels were taken over by other processes sharing the ledger
+            message += f", {self.summary['released']} left to other processes"
+        if self.summary.get("failed_channels"):
+            message += f", {self.summary['failed_channels']} channels failed"
+        if self.summary["failed"] or self.summary.get("failed_channels"):
+            logger.warning(message)
+        else:
+            logger.info(message)
+
+
+class ChannelProgress:
+    def __init__(self, channel_id: str, on_advance, ascending: bool = False) -> None:
+        # on_advance(channel_id, message_id) is called with the newest message id whose
+        # attachments, and the attachments of every message before it, are all on disk
+        self.channel_id = channel_id
+        self.on_advance = on_advance
+        self.ascending = ascending
+        self.pending = OrderedDict()
+        self.newest = None
+        self.failed = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add(self, message_id: str, attachments: int = 0) -> None:
+        with self.lock:
+            if self.newest is None or int(message_id) > int(self.newest):
+                self.newest = message_id
+            self.pending[message_id] = self.pending.get(message_id, 0) + attachments
+        self._advance()
+
+    def done(self, message_id: str, ok: bool = True) -> None:
+        with self.lock:
+            if ok:
+                self.pending[message_id] -= 1
+            else:
+                # a failed message is never completed so nothing after it is committed
+                self.failed = True
+                self.pending[message_id] = float("inf")
+        self._advance()
+
+    def close(self) -> None:
+        # called once pagination for the channel has finished
+        with self.lock:
+            self.closed = True
+        self._advance()
+
+    def _advance(self) -> None:
+        advance_to = None
+        with self.lock:
+            if self.ascending:
+                # messages are added oldest first, so the completed prefix is safe
+                while self.pending and next(iter(self.pending.values())) <= 0:
+                    advance_to, _ = self.pending.popitem(last=False)
+            elif self.closed and all(count <= 0 for count in self.pending.values()):
+                self.pending.clear()
+            if (
+                self.closed
+                and not self.failed
+                and not self.pending
+                and self.newest is not None
+            ):
+                advance_to = self.newest
+                self.newest = None
+        if advance_to is not None:
+            self.on_advance(self.channel_id, advance_to)
@@ -0,0 +1,103 @@
+import csv
+import json
+import threading
+from collections import defaultdict
+
+from logger import logger
+
+PLAN_FIELDS = (
+    "channel_id",
+    "message_id",
+    "attachment_id",
+    "filename",
+    "size",
+    "content_type",
+    "url",
+    "path",
+    "status",
+    "collides_with",
+)
+
+
+class PlanWriter:
+    # writes one row per attachment that would be downloaded, without touching the cdn.
+    # status is one of
+    #   new         nothing at the path yet
+    #   downloaded  the download manifest says the file is already there
+    #   exists      a file with the same size is at the path, it would be hash checked
+    #   conflict    a file with a different size is at the path
+    # collides_with is set when an earlier attachment in the plan has the same path
+    def __init__(self, path: str, plan_format: str = None) -> None:
+        self.path = path
+        if plan_format is None:
+            plan_format = "csv" if path.lower().endswith(".csv") else "ndjson"
+        self.plan_format = plan_format
+        self.lock = threading.Lock()
+        self.file = open(path, "w", newline="")
+        if plan_format == "csv":
+            self.writer = csv.DictWriter(self.file, fieldnames=PLAN_FIELDS)
+            self.writer.writeheader()
+        # path -> attachment id of the first attachment planned there
+        self.paths = {}
+        self.counts = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.collisions = 0
+
+    def add(self, attachment: dict, variables: dict, filepath: str, status: str) -> None:
+        size = attachment.get("size", 0)
+        with self.lock:
+            collides_with = self.paths.setdefault(filepath, attachment["id"])
+            if collides_with == attachment["id"]:
+                collides_with = ""
+            else:
+                self.collisions += 1
+                logger.debug(
+                    f"Attachment id {attachment['id']} has the same path as attachment id {collides_with}: {filepath}"
+                )
+            self.counts[status] += 1
+            self.bytes[status] += size
+            row = {
+                "channel_id": variables.get("channel_id"),
+                "message_id": variables["message_id"],
+                "attachment_id": attachment["id"],
+                "filename": attachment["filename"],
+                "size": size,
+                "content_type": attachment.get("content_type", ""),
+                "url": attachment["url"],
+                "path": filepath,
+                "status": status,
+                "collides_with": collides_with,
+            }
+            if self.plan_format == "csv":
+                self.writer.writerow(row)
+            else:
+                self.file.write(json.dumps(row) + "\n")
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "attachments": sum(self.counts.values()),
+                "total_bytes": sum(self.bytes.values()),
+                # conflicting files are downloaded again, existing ones only if their hash differs
+                "download_bytes": self.bytes.get("new", 0) + self.bytes.get("conflict", 0),
+                "collisions": self.collisions,
+                "status": dict(self.counts),
+                "status_bytes": dict(self.bytes),
+            }
+
+    def close(self) -> None:
+        summary = self.summary()
+        if self.plan_format != "csv":
+            self.file.write(json.dumps({"summary": summary}) + "\n")
+        self.file.close()
+        logger.info(
+            f"Planned {summary['attachments']} attachments, {summary['total_bytes'] / 2**20:.1f} MB in total, "
+            f"{summary['download_bytes'] / 2**20:.1f} MB to download, {summary['collisions']} path collisions. "
+            f"Wrote the plan to {self.path}"
+        )
+        if summary["collisions"]:
+            logger.warning(
+                f"{summary['collisions']} attachments would be saved to a path another attachment already uses, see collides_with in the plan"
+            )
+        for status, count in sorted(summary["status"].items()):
+            logger.info(f"  {status}: {count} attachments, {summary['status_bytes'][status] / 2**20:.1f} MB")
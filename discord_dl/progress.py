@@ -0,0 +1,196 @@
+import logging
+import sys
+import threading
+import time
+
+from logger import logger
+
+
+class Transfer:
+    # downloaded is only ever written by the thread that owns the transfer, the renderer
+    # just reads it. offset is the number of bytes that were on disk before it started
+    __slots__ = ("filename", "total", "offset", "downloaded", "start")
+
+    def __init__(self, filename: str, total: int, offset: int = 0) -> None:
+        self.filename = filename
+        self.total = total
+        self.offset = offset
+        self.downloaded = 0
+        self.start = time.monotonic()
+
+
+class ProgressLogHandler(logging.Handler):
+    # passes log records to handler through the renderer, so they are written on lines of
+    # their own above the progress instead of into it
+    def __init__(self, renderer, handler: logging.Handler) -> None:
+        super().__init__(handler.level)
+        self.renderer = renderer
+        self.handler = handler
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.renderer.write_log(self.handler, record)
+
+
+class ProgressRenderer:
+    def __init__(
+        self,
+        refresh_interval: float = 0.5,
+        log_interval: float = 10.0,
+        per_file: bool = False,
+        stream=None,
+    ) -> None:
+        self.refresh_interval = refresh_interval
+        self.log_interval = log_interval
+        self.per_file = per_file
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.lock = threading.Lock()
+        self.transfers = set()
+        self.finished_files = 0
+        self.finished_bytes = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        # the lines currently on the terminal, drawing and log records take turns
+        self.frame = []
+        self.draw_lock = threading.Lock()
+        self.log_handlers = []
+        self.last_sample = (time.monotonic(), 0)
+        self.rate = 0.0
+
+    def start_transfer(self, filename: str, total: int, offset: int = 0) -> Transfer:
+        transfer = Transfer(filename, total, offset)
+        with self.lock:
+            self.transfers.add(transfer)
+        return transfer
+
+    def finish_transfer(self, transfer: Transfer) -> None:
+        with self.lock:
+            self.transfers.discard(transfer)
+            self.finished_files += 1
+            self.finished_bytes += transfer.downloaded
+
+    def start(self) -> None:
+        if self.thread:
+            return
+        self.stop_event.clear()
+        self.last_sample = (time.monotonic(), 0)
+        if self.tty:
+            self.log_handlers = list(logger.handlers)
+            for handler in self.log_handlers:
+                logger.removeHandler(handler)
+                logger.addHandler(ProgressLogHandler(self, handler))
+        self.thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if not self.thread:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        if self.tty:
+            self._draw(final=True)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            for handler in self.log_handlers:
+                logger.addHandler(handler)
+            self.log_handlers = []
+
+    def _run(self) -> None:
+        interval = self.refresh_interval if self.tty else self.log_interval
+        while not self.stop_event.wait(interval):
+            if self.tty:
+                self._draw()
+            else:
+                with self.lock:
+                    active = bool(self.transfers)
+                if active:
+                    logger.info(self._summary())
+
+    def _snapshot(self) -> tuple:
+        with self.lock:
+            transfers = list(self.transfers)
+            finished_files = self.finished_files
+            finished_bytes = self.finished_bytes
+        in_flight = sum(transfer.downloaded for transfer in transfers)
+        return transfers, finished_files, finished_bytes + in_flight
+
+    def _summary(self, transfers: list = None, finished_files: int = None, total_bytes: int = None) -> str:
+        if transfers is None:
+            transfers, finished_files, total_bytes = self._snapshot()
+        now = time.monotonic()
+        last_time, last_bytes = self.last_sample
+        if now - last_time > 0:
+            # exponential smoothing keeps the rate readable between refreshes
+            rate = max(0, total_bytes - last_bytes) / (now - last_time)
+            self.rate = rate if not self.rate else 0.7 * self.rate + 0.3 * rate
+        self.last_sample = (now, total_bytes)
+        remaining = sum(
+            max(0, transfer.total - transfer.offset - transfer.downloaded)
+            for transfer in transfers
+            if transfer.total
+        )
+        eta = format_eta(remaining / self.rate) if self.rate and remaining else "--:--:--"
+        return (
+            f"{format_bytes(total_bytes)} at {format_bytes(self.rate)}/s | "
+            f"{len(transfers)} active, {finished_files} done | ETA {eta}"
+        )
+
+    def _draw(self, final: bool = False) -> None:
+        transfers, finished_files, total_bytes = self._snapshot()
+        lines = [self._summary(transfers, finished_files, total_bytes)]
+        if self.per_file and not final:
+            for transfer in sorted(transfers, key=lambda transfer: transfer.start):
+                lines.append(format_transfer(transfer))
+        with self.draw_lock:
+            self._clear()
+            self.frame = lines
+            self._write_frame()
+            if final:
+                # the last frame stays on the terminal
+                self.stream.write("\n")
+                self.stream.flush()
+                self.frame = []
+
+    def write_log(self, handler: logging.Handler, record: logging.LogRecord) -> None:
+        with self.draw_lock:
+            self._clear()
+            handler.handle(record)
+            self._write_frame()
+
+    def _clear(self) -> None:
+        # back to the first line of the frame, then clear it and everything below
+        if not self.frame:
+            return
+        move = f"\x1b[{len(self.frame) - 1}F" if len(self.frame) > 1 else "\r"
+        self.stream.write(f"{move}\x1b[J")
+        self.stream.flush()
+
+    def _write_frame(self) -> None:
+        # the cursor stays at the end of the last line, so _clear knows where the frame is
+        if not self.frame:
+            return
+        self.stream.write("\n".join(self.frame))
+        self.stream.flush()
+
+
+def format_transfer(transfer: Transfer) -> str:
+    name = transfer.filename if len(transfer.filename) <= 40 else transfer.filename[:37] + "..."
+    downloaded = transfer.offset + transfer.downloaded
+    if transfer.total:
+        percent = int(100 * downloaded / transfer.total)
+        return f"  {name:<40} {percent:>3}% {format_bytes(downloaded)}/{format_bytes(transfer.total)}"
+    return f"  {name:<40}   ?% {format_bytes(downloaded)}"
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
@@ -0,0 +1,99 @@
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from logger import logger
+from metrics import endpoint_name, metrics
+
+# discord keeps a separate rate limit per bucket for each channel, guild and webhook
+MAJOR_PARAMETER_PATTERN = re.compile(r"/(channels|guilds|webhooks)/(\d+)")
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # route -> bucket hash from the X-RateLimit-Bucket header
+        self.routes = {}
+        # (bucket hash or route, major parameter) -> [remaining, reset time]
+        self.buckets = {}
+        self.global_reset = 0.0
+
+    def _key(self, route: str) -> tuple:
+        match = MAJOR_PARAMETER_PATTERN.search(route)
+        major = match.group(0) if match else ""
+        return self.routes.get(route, route), major
+
+    def wait(self, route: str) -> None:
+        # blocks only while this route's bucket (or the global limit) is exhausted
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.global_reset - now
+                bucket = self.buckets.get(self._key(route))
+                if bucket and bucket[1] > now:
+                    if bucket[0] <= 0:
+                        delay = max(delay, bucket[1] - now)
+                    elif delay <= 0:
+                        # reserve a request so concurrent callers do not overrun the bucket
+                        bucket[0] -= 1
+                if delay <= 0:
+                    return
+            logger.debug(f"Rate limited on {route}, waiting {delay:.2f} seconds")
+            time.sleep(delay)
+
+    def update(self, route: str, response: requests.Response) -> float:
+        # returns how long to wait before retrying when the response was a 429
+        headers = response.headers
+        now = time.monotonic()
+        retry_after = 0.0
+        with self.lock:
+            bucket_hash = headers.get("X-RateLimit-Bucket")
+            if bucket_hash:
+                self.routes[route] = bucket_hash
+            key = self._key(route)
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset_after = headers.get("X-RateLimit-Reset-After")
+            if remaining is not None and reset_after is not None:
+                self.buckets[key] = [int(remaining), now + float(reset_after)]
+            if response.status_code == 429:
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                retry_after = float(
+                    body.get("retry_after", headers.get("Retry-After", 1))
+                )
+                if body.get("global") or headers.get("X-RateLimit-Global"):
+                    self.global_reset = max(self.global_reset, now + retry_after)
+                else:
+                    self.buckets[key] = [0, now + retry_after]
+        return retry_after
+
+
+class RateLimitedSession(requests.Session):
+    def __init__(self, limiter: RateLimiter = None, max_429_retries: int = 5) -> None:
+        super().__init__()
+        self.limiter = limiter or RateLimiter()
+        self.max_429_retries = max_429_retries
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        path = urlparse(url).path
+        route = f"{method.upper()} {path}"
+        endpoint = endpoint_name(path)
+        attempts = 0
+        while True:
+            with metrics.timer("rate_limit_wait"):
+                self.limiter.wait(route)
+            response = super().request(method, url, *args, **kwargs)
+            metrics.increment("api_requests", endpoint=endpoint)
+            retry_after = self.limiter.update(route, response)
+            if response.status_code == 429:
+                metrics.increment("rate_limited", endpoint=endpoint)
+            if response.status_code != 429 or attempts >= self.max_429_retries:
+                return response
+            attempts += 1
+            logger.warning(
+                f"429 Too Many Requests for {route}, retrying in {retry_after:.2f} seconds ({attempts}/{self.max_429_retries})"
+            )
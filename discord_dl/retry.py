@@ -0,0 +1,138 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from logger import logger
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+
+# failures worth trying again, everything else fails right away
+RETRYABLE = {"timeout", "connection", "server", "rate_limited", "incomplete"}
+
+
+def classify_error(error: Exception) -> str:
+    if isinstance(error, requests.exceptions.Timeout):
+        return "timeout"
+    # a reset or dropped connection, also when it happens while the body streams in
+    if isinstance(
+        error,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ContentDecodingError,
+        ),
+    ):
+        return "connection"
+    return "fatal"
+
+
+def classify_status(status: int) -> str:
+    if status == 408 or status >= 500:
+        return "server"
+    if status == 429:
+        return "rate_limited"
+    # on the cdn a 403 usually means the signed attachment url expired
+    if status in (401, 403):
+        return "forbidden"
+    if status == 404:
+        return "not_found"
+    return "fatal"
+
+
+def backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    # exponential backoff with full jitter, so workers that failed together do not all
+    # retry at the same moment
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = 10, base_delay: float = 1.0, max_delay: float = 60.0) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, kind: str, attempt: int, max_retries: int = None) -> bool:
+        if max_retries is None:
+            max_retries = self.max_retries
+        return kind in RETRYABLE and attempt < max_retries
+
+    def wait(self, attempt: int) -> float:
+        delay = backoff(attempt, self.base_delay, self.max_delay)
+        with metrics.timer("backoff"):
+            time.sleep(delay)
+        return delay
+
+
+class CircuitBreaker:
+    # tracks failures per host. after failure_threshold failures in a row the host is
+    # open for cooldown seconds, and requests to it wait instead of failing. then a single
+    # request is let through: if it works the host is closed again, otherwise the
+    # cooldown doubles. other hosts are not affected
+    def __init__(
+        self, failure_threshold: int = 5, cooldown: float = 5.0, max_cooldown: float = 120.0
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        # host -> {"failures", "open_until", "cooldown", "probing"}
+        self.hosts = {}
+
+    def before_request(self, host: str) -> None:
+        while True:
+            with self.lock:
+                state = self.hosts.get(host)
+                if state is None or state["failures"] < self.failure_threshold:
+                    return
+                now = time.monotonic()
+                if now >= state["open_until"] and not state["probing"]:
+                    state["probing"] = True
+                    return
+                # while the probe is out the others check back shortly
+                delay = max(state["open_until"] - now, 0.1)
+            with metrics.timer("circuit_open"):
+                time.sleep(delay)
+
+    def record(self, host: str, ok: bool) -> None:
+        with self.lock:
+            state = self.hosts.setdefault(
+                host, {"failures": 0, "open_until": 0.0, "cooldown": self.cooldown, "probing": False}
+            )
+            state["probing"] = False
+            if ok:
+                if state["failures"] >= self.failure_threshold:
+                    logger.info(f"{host} is responding again")
+                state["failures"] = 0
+                state["cooldown"] = self.cooldown
+                return
+            state["failures"] += 1
+            now = time.monotonic()
+            # failures of requests that were already in flight do not extend the pause
+            if state["failures"] >= self.failure_threshold and now >= state["open_until"]:
+                logger.warning(
+                    f"{state['failures']} failed requests in a row to {host}, pausing requests to it for {state['cooldown']:.0f} seconds"
+                )
+                metrics.increment("circuit_opened", host=host)
+                state["open_until"] = now + state["cooldown"]
+                state["cooldown"] = min(state["cooldown"] * 2, self.max_cooldown)
+
+
+class CircuitBreakerAdapter(HTTPAdapter):
+    # connection errors, timeouts and 5xx responses count as failures of the host
+    def __init__(self, breaker: CircuitBreaker, *args, **kwargs) -> None:
+        self.breaker = breaker
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        host = urlparse(request.url).netloc
+        self.breaker.before_request(host)
+        try:
+            response = super().send(request, *args, **kwargs)
+        except Exception:
+            # also releases the probe when the request failed some other way
+            self.breaker.record(host, False)
+            raise
+        self.breaker.record(host, response.status_code < 500)
+        return response
@@ -0,0 +1,156 @@
+import json
+import os
+import signal
+import time
+
+from arguments import parse_date, parse_size
+from logger import logger
+from metrics import metrics, write_atomic
+
+# options of the connections the service was started with, jobs can not change them
+SERVICE_OPTIONS = (
+    "token",
+    "api_url",
+    "concurrent_downloads",
+    "concurrent_channels",
+    "segments",
+    "progress",
+    "progress_files",
+    "serve",
+    "poll_interval",
+)
+DATE_OPTIONS = ("date", "date_before", "date_after")
+SIZE_OPTIONS = ("min_size", "max_size", "segment_threshold", "write_buffer")
+JOB_SUFFIX = ".json"
+RUNNING_SUFFIX = ".running"
+
+
+class SpoolService:
+    # a job is a json file of options in the spool directory, using the same names as
+    # the command line options, e.g. {"channel_ids": ["1234"], "path": "/data", "incremental": true}
+    # options the job does not set are taken from the command line the service was started
+    # with. a job is claimed by renaming it, and moved to done/ or failed/ with a
+    # .result.json next to it when it is finished
+    def __init__(self, downloader, spool_dir: str, options: dict, poll_interval: float = 1.0) -> None:
+        self.downloader = downloader
+        self.spool_dir = spool_dir
+        self.options = options
+        self.poll_interval = poll_interval
+        self.done_dir = os.path.join(spool_dir, "done")
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        os.makedirs(self.done_dir, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def serve(self) -> None:
+        # SIGTERM stops the service the same way Ctrl-C does
+        previous_handler = signal.signal(signal.SIGTERM, self.terminate)
+        logger.info(f"Waiting for jobs in {self.spool_dir}")
+        try:
+            self.recover()
+            while True:
+                running_path = self.next_job()
+                if running_path is None:
+                    time.sleep(self.poll_interval)
+                elif not self.run_job(running_path):
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+        logger.info("Stopped waiting for jobs")
+
+    def terminate(self, signum, frame) -> None:
+        raise KeyboardInterrupt
+
+    def recover(self) -> None:
+        # jobs that were running when the service died are queued again
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(JOB_SUFFIX + RUNNING_SUFFIX):
+                logger.info(f"Queueing unfinished job {name[: -len(RUNNING_SUFFIX)]} again")
+                self.requeue(os.path.join(self.spool_dir, name))
+
+    def next_job(self):
+        # the oldest name first. the rename is atomic, so several services can share a
+        # spool directory without running a job twice
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith(JOB_SUFFIX):
+                continue
+            job_path = os.path.join(self.spool_dir, name)
+            running_path = job_path + RUNNING_SUFFIX
+            try:
+                os.rename(job_path, running_path)
+            except FileNotFoundError:
+                continue
+            return running_path
+        return None
+
+    def run_job(self, running_path: str) -> bool:
+        # returns False when the job was interrupted and the service should stop
+        name = os.path.basename(running_path)[: -len(RUNNING_SUFFIX)]
+        start = time.time()
+        metrics.reset()
+        try:
+            with open(running_path, "r") as f:
+                job = json.load(f)
+            options = {**self.options, **parse_job(job)}
+            logger.info(f"Starting job {name}")
+            self.downloader.set_options(options)
+            summary = self.downloader.download()
+        except KeyboardInterrupt:
+            self.requeue(running_path)
+            raise
+        except Exception as e:
+            logger.exception(f"Job {name} failed")
+            self.finish(running_path, self.failed_dir, {"error": repr(e)})
+            return True
+        if summary["interrupted"]:
+            self.requeue(running_path)
+            return False
+        logger.info(f"Finished job {name} in {time.time() - start:.1f} seconds")
+        self.finish(
+            running_path,
+            self.done_dir,
+            {
+                "seconds": round(time.time() - start, 3),
+                "summary": summary,
+                "metrics": metrics.summary(),
+            },
+        )
+        return True
+
+    def requeue(self, running_path: str) -> None:
+        # the job continues from its journal when it runs again
+        job_path = running_path[: -len(RUNNING_SUFFIX)]
+        try:
+            with open(running_path, "r") as f:
+                job = json.load(f)
+            if isinstance(job, dict):
+                job["resume_run"] = True
+                write_atomic(running_path, json.dumps(job))
+        except (OSError, ValueError):
+            pass
+        os.replace(running_path, job_path)
+
+    def finish(self, running_path: str, directory: str, result: dict) -> None:
+        name = os.path.basename(running_path)[: -len(RUNNING_SUFFIX)]
+        os.replace(running_path, os.path.join(directory, name))
+        result_path = os.path.join(directory, name[: -len(JOB_SUFFIX)] + ".result.json")
+        write_atomic(result_path, json.dumps(result, indent=2, default=str))
+
+
+def parse_job(job: dict) -> dict:
+    if not isinstance(job, dict):
+        raise ValueError(f"A job must be a json object of options, got {type(job).__name__}")
+    options = {}
+    for key, value in job.items():
+        if key in SERVICE_OPTIONS:
+            logger.warning(f"Ignoring {key} in job, it can only be set when starting the service")
+            continue
+        if key in DATE_OPTIONS and isinstance(value, str):
+            value = parse_date(value)
+        elif key in SIZE_OPTIONS and value is not None:
+            value = parse_size(value)
+        elif key == "channel_ids" and isinstance(value, str):
+            value = [value]
+        options[key] = value
+    return options
@@ -0,0 +1,181 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_FILENAME = ".discord_dl.sqlite3"
+
+
+class StateStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.db_path = os.path.join(path, STATE_FILENAME)
+        self.lock = threading.Lock()
+        # shared by the download workers, every access goes through self.lock. other
+        # processes sharing the download path through the ledger are waited for
+        self.connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS channels (
+                    channel_id TEXT PRIMARY KEY,
+                    last_message_id INTEGER NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS attachments (
+                    attachment_id TEXT PRIMARY KEY,
+                    channel_id TEXT,
+                    message_id TEXT,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    md5 TEXT,
+                    mtime REAL NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS metadata (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS threads (
+                    thread_id TEXT PRIMARY KEY,
+                    parent_id TEXT NOT NULL,
+                    value TEXT NOT NULL
+                )"""
+            )
+            # the newest archive timestamp seen for each channel and kind of archived threads
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS thread_cursors (
+                    channel_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    archive_timestamp TEXT NOT NULL,
+                    PRIMARY KEY (channel_id, kind)
+                )"""
+            )
+
+    def get_last_message_id(self, channel_id: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT last_message_id FROM channels WHERE channel_id = ?",
+                (channel_id,),
+            ).fetchone()
+        return str(row[0]) if row else None
+
+    def set_last_message_id(self, channel_id: str, message_id: str) -> None:
+        # the high-water mark only ever moves forward
+        with self.lock, self.connection:
+            self.connection.execute(
+                """INSERT INTO channels (channel_id, last_message_id) VALUES (?, ?)
+                ON CONFLICT(channel_id) DO UPDATE SET last_message_id = excluded.last_message_id
+                WHERE excluded.last_message_id > channels.last_message_id""",
+                (channel_id, int(message_id)),
+            )
+
+    def get_attachment(self, attachment_id: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT path, size, md5, mtime FROM attachments WHERE attachment_id = ?",
+                (attachment_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"path": row[0], "size": row[1], "md5": row[2], "mtime": row[3]}
+
+    def set_attachment(
+        self,
+        attachment_id: str,
+        channel_id: str,
+        message_id: str,
+        path: str,
+        size: int,
+        md5: str,
+        mtime: float,
+    ) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (attachment_id, channel_id, message_id, path, size, md5, mtime),
+            )
+
+    def get_attachments(self) -> list:
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT attachment_id, channel_id, message_id, path, size, md5, mtime
+                FROM attachments"""
+            ).fetchall()
+        return [
+            {
+                "attachment_id": row[0],
+                "channel_id": row[1],
+                "message_id": row[2],
+                "path": row[3],
+                "size": row[4],
+                "md5": row[5],
+                "mtime": row[6],
+            }
+            for row in rows
+        ]
+
+    def get_metadata(self, key: str, max_age: float):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM metadata WHERE key = ? AND updated > ?",
+                (key, time.time() - max_age),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_metadata(self, key: str, value: dict) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+
+    def delete_metadata(self, key: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM metadata WHERE key = ?", (key,))
+
+    def get_threads(self, parent_id: str) -> list:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT value FROM threads WHERE parent_id = ?", (parent_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def set_threads(self, threads: list) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO threads VALUES (?, ?, ?)",
+                [(thread["id"], thread["parent_id"], json.dumps(thread)) for thread in threads],
+            )
+
+    def delete_threads(self, thread_ids: list) -> int:
+        # returns how many of the threads were stored
+        with self.lock, self.connection:
+            cursor = self.connection.executemany(
+                "DELETE FROM threads WHERE thread_id = ?", [(thread_id,) for thread_id in thread_ids]
+            )
+        return cursor.rowcount
+
+    def get_thread_cursor(self, channel_id: str, kind: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT archive_timestamp FROM thread_cursors WHERE channel_id = ? AND kind = ?",
+                (channel_id, kind),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_thread_cursor(self, channel_id: str, kind: str, archive_timestamp: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO thread_cursors VALUES (?, ?, ?)",
+                (channel_id, kind, archive_timestamp),
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -2,31 +2,99 @@ import hashlib
 import random
 import re
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 
 from logger import logger
+from metrics import metrics
+
+DISCORD_EPOCH = 1420070400000
 
 
 def mysleep(sleep_base: int, sleep_range: list):
     if sleep_base or (sleep_range[0] != 0 and sleep_range[1] != 0):
         sleep = sleep_base + random.uniform(sleep_range[0], sleep_range[1])
         logger.info(f"Sleeping for {sleep} seconds")
-        time.sleep(sleep)
+        with metrics.timer("sleep"):
+            time.sleep(sleep)
 
 
 def convert_discord_timestamp(timestamp):
+    # discord timestamps are iso 8601, which fromisoformat parses much faster than strptime
+    try:
+        return datetime.fromisoformat(timestamp)
+    except ValueError:
+        pass
     try:
         return datetime.strptime(timestamp, r"%Y-%m-%dT%H:%M:%S.%f%z")
     except ValueError:
         return datetime.strptime(timestamp, r"%Y-%m-%dT%H:%M:%S%z")
 
 
-def calculate_md5(file_path) -> str:
+def datetime_to_snowflake(date: datetime) -> int:
+    # naive datetimes are treated as UTC, the same way message timestamps are compared
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return (int(date.timestamp() * 1000) - DISCORD_EPOCH) << 22
+
+
+def snowflake_to_datetime(snowflake) -> datetime:
+    return datetime.fromtimestamp(
+        ((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000, tz=timezone.utc
+    )
+
+
+def calculate_md5(file_path, buffer_size: int = 4 * 2**20) -> str:
+    # large reads into one reused buffer, small reads make hashing big files syscall bound
     hash_md5 = hashlib.md5()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            hash_md5.update(view[:size])
+    return hash_md5.hexdigest()
+
+
+def update_md5(hash_md5, file_path, size: int) -> None:
+    # hashes the first size bytes of a file
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        while size > 0:
+            chunk = f.read(min(size, 2**20))
+            if not chunk:
+                break
             hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+            size -= len(chunk)
+
+
+def etag_md5(etag: str):
+    # the cdn uses the md5 of the file as its ETag, multipart ETags are not plain md5s
+    etag = etag.removeprefix("W/").strip('"')
+    if re.fullmatch(r"[0-9a-f]{32}", etag):
+        return etag
+    return None
+
+
+# a channel url without a channel id points at a whole server
+SERVER_URL_PATTERN = re.compile(r"https://discord.com/channels/(\d+)/?")
+
+
+def is_server_url(value: str) -> bool:
+    return SERVER_URL_PATTERN.fullmatch(value.strip()) is not None
+
+
+def extract_server_ids(server_ids):
+    results = []
+    for server_id in server_ids:
+        match = SERVER_URL_PATTERN.fullmatch(server_id.strip()) or re.fullmatch(
+            r"\d+", server_id.strip()
+        )
+        if match:
+            results.append(match.group(1) if match.groups() else match.group(0))
+        else:
+            logger.warning(f"Could not find discord server id in: {server_id}")
+    return results
 
 
 def extract_channel_ids(channel_ids):
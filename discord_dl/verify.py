@@ -0,0 +1,188 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from filenaming import create_attachment_variables, create_message_variables
+from logger import logger
+from metrics import metrics
+from pipeline import DownloadPipeline
+from utils import calculate_md5
+
+# files that are not what the manifest recorded and are downloaded again by --repair
+BAD_STATUSES = ("missing", "truncated", "corrupted", "partial")
+PROGRESS_INTERVAL = 10.0
+
+
+class LibraryVerifier:
+    # checks every file in the download manifest against the size and md5 it was saved
+    # with, which is the md5 the cdn sent as its ETag. hashing runs in a process pool, so
+    # a large library is read by every core at once instead of a single thread.
+    # statuses are
+    #   ok         the file has the recorded size and md5
+    #   missing    the file is gone
+    #   truncated  the file is smaller than recorded
+    #   corrupted  the file has a different size or md5
+    #   partial    not ok, and a .part or .resume file says a download of it never finished
+    #   error      the file could not be read
+    def __init__(self, downloader, processes: int = 0) -> None:
+        self.downloader = downloader
+        self.processes = processes or os.cpu_count() or 1
+
+    def run(self, repair: bool = False) -> dict:
+        state = self.downloader.state
+        entries = state.get_attachments()
+        partial = self.find_partial_files()
+        logger.info(
+            f"Verifying {len(entries)} files, {sum(entry['size'] for entry in entries) / 2**30:.1f} GB "
+            f"with {self.processes} processes"
+        )
+        counts = defaultdict(int)
+        bad = []
+        start = last_log = time.monotonic()
+        checked_bytes = 0
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            # the largest files first, so one big file does not finish long after the rest
+            entries.sort(key=lambda entry: entry["size"], reverse=True)
+            tasks = [(entry["path"], entry["size"], entry["md5"]) for entry in entries]
+            with metrics.timer("hashing"):
+                for i, (entry, (status, mtime)) in enumerate(
+                    zip(entries, executor.map(check_file, tasks, chunksize=8)), 1
+                ):
+                    if status != "ok" and entry["path"] in partial:
+                        # the unfinished download is continued instead of starting over
+                        status = "partial"
+                        partial.discard(entry["path"])
+                    counts[status] += 1
+                    checked_bytes += entry["size"]
+                    metrics.increment("verified", status=status)
+                    if status == "ok" and mtime != entry["mtime"]:
+                        # touched but unchanged, so later runs can trust the manifest again
+                        state.set_attachment(**{**entry, "mtime": mtime})
+                    elif status != "ok":
+                        logger.warning(f"{status}: {entry['path']}")
+                        if status in BAD_STATUSES:
+                            bad.append(entry)
+                    if time.monotonic() - last_log >= PROGRESS_INTERVAL:
+                        last_log = time.monotonic()
+                        logger.info(
+                            f"Verified {i} of {len(entries)} files, "
+                            f"{checked_bytes / 2**20 / (last_log - start):.1f} MB/s"
+                        )
+        for path in sorted(partial):
+            # next to a file that is ok, or not in the manifest so there is no message to
+            # download it from
+            logger.warning(
+                f"Unfinished download --repair does not continue, see --resume-run: {path}"
+            )
+        summary = {
+            "files": len(entries),
+            "bytes": checked_bytes,
+            "seconds": round(time.monotonic() - start, 3),
+            "status": dict(counts),
+            "unknown_partial": len(partial),
+        }
+        logger.info(
+            f"Verified {len(entries)} files in {summary['seconds']:.1f} seconds: "
+            + ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+        )
+        if bad and repair:
+            summary["repair"] = self.repair(bad)
+        elif bad:
+            logger.info(f"Download the {len(bad)} bad files again with --repair")
+        return summary
+
+    def find_partial_files(self) -> set:
+        # the paths of downloads that were interrupted: a .part file, or a file with a
+        # .resume state next to it when temp files are off
+        partial = set()
+        for root, _, files in os.walk(self.downloader.path):
+            for name in files:
+                if name.endswith(".part"):
+                    partial.add(os.path.join(root, name[: -len(".part")]))
+                elif name.endswith(".resume") and not name.endswith(".part.resume"):
+                    partial.add(os.path.join(root, name[: -len(".resume")]))
+        return partial
+
+    def repair(self, entries: list) -> dict:
+        # the attachment urls expire, so every message is looked up again for a fresh one
+        downloader = self.downloader
+        pipeline = DownloadPipeline(self.repair_job, downloader.concurrent_downloads)
+        pipeline.start()
+        if downloader.progress:
+            downloader.progress.start()
+        try:
+            entries = sorted(entries, key=lambda entry: (entry["channel_id"], entry["message_id"]))
+            for entry in entries:
+                job = self.find_attachment(entry)
+                if job:
+                    pipeline.put(job, entry["channel_id"])
+                else:
+                    with pipeline.lock:
+                        pipeline.summary["failed"] += 1
+            pipeline.close()
+        finally:
+            if downloader.progress:
+                downloader.progress.stop()
+        pipeline.log_summary()
+        return dict(pipeline.summary)
+
+    def find_attachment(self, entry: dict):
+        downloader = self.downloader
+        try:
+            channel_variables = downloader.get_channel_info(entry["channel_id"])
+            message = downloader.get_message(entry["channel_id"], entry["message_id"])
+        except Exception:
+            logger.exception(f"Failed to look up message id {entry['message_id']}")
+            return None
+        attachment = None
+        if message:
+            attachment = next(
+                (
+                    attachment
+                    for attachment in message["attachments"]
+                    if attachment["id"] == entry["attachment_id"]
+                ),
+                None,
+            )
+        if attachment is None:
+            logger.error(
+                f"Attachment id {entry['attachment_id']} is no longer on discord: {entry['path']}"
+            )
+            return None
+        variables = {
+            **create_attachment_variables(attachment),
+            **create_message_variables(message),
+            **channel_variables,
+        }
+        return attachment, variables, entry["path"]
+
+    def repair_job(self, job: tuple) -> str:
+        attachment, variables, filepath = job
+        # a bad file would be taken for the finished download. the attachment was just
+        # found on discord, so it is removed, unless it is itself the unfinished download
+        # of a run without temp files
+        if not os.path.exists(filepath + ".resume"):
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+        return self.downloader.download_attachment(attachment, variables, filepath)
+
+
+def check_file(task: tuple) -> tuple:
+    # runs in a worker process, returns (status, mtime)
+    path, size, md5 = task
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return "missing", None
+    except OSError:
+        return "error", None
+    if stat.st_size != size:
+        return "truncated" if stat.st_size < size else "corrupted", stat.st_mtime
+    try:
+        local_md5 = calculate_md5(path)
+    except OSError:
+        return "error", stat.st_mtime
+    return "ok" if local_md5 == md5 else "corrupted", stat.st_mtime
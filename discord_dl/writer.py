@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+
+from metrics import metrics
+
+# writes go to disk in blocks of this size, on block boundaries of the file
+WRITE_BLOCK_SIZE = 2**20
+
+
+class BufferedFileWriter:
+    # separates receiving a download from writing it. chunks from the network are gathered
+    # into aligned blocks and handed to a writer thread through a queue of buffer_size
+    # bytes, so slow storage only stalls the connection once the buffer is full.
+    # buffer_size 0 writes every chunk in the calling thread as it arrives.
+    # fsync is one of
+    #   none   leave flushing to the operating system
+    #   file   fsync once the file is complete
+    #   block  fsync after every block
+    # checkpoint is called with the position every checkpoint_interval bytes, once
+    # everything before that position is written
+    def __init__(
+        self,
+        file: str,
+        position: int = 0,
+        buffer_size: int = 0,
+        fsync: str = "none",
+        hash_md5=None,
+        checkpoint=None,
+        checkpoint_interval: int = 0,
+    ) -> None:
+        self.file = open(file, "r+b")
+        self.file.seek(position)
+        self.position = position
+        self.fsync = fsync
+        self.hash_md5 = hash_md5
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.next_checkpoint = position + checkpoint_interval
+        self.error = None
+        self.thread = None
+        if buffer_size > 0:
+            self.block_size = min(WRITE_BLOCK_SIZE, buffer_size)
+            # the first block ends on a block boundary, so every later one is aligned
+            self.next_block = self.block_size - position % self.block_size
+            self.buffer = bytearray()
+            self.queue = queue.Queue(maxsize=max(1, buffer_size // self.block_size))
+            self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+            self.thread.start()
+
+    def write(self, chunk: bytes) -> None:
+        if self.error:
+            raise self.error
+        if self.thread is None:
+            self.write_block(chunk)
+            return
+        self.buffer += chunk
+        while len(self.buffer) >= self.next_block:
+            block = bytes(self.buffer[: self.next_block])
+            del self.buffer[: self.next_block]
+            self.next_block = self.block_size
+            # blocks while the writer is a full buffer behind
+            self.queue.put(block)
+
+    def run(self) -> None:
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            # after an error the queue is still drained, so write does not block forever
+            if self.error:
+                continue
+            try:
+                self.write_block(block)
+            except Exception as e:
+                self.error = e
+
+    def write_block(self, block: bytes) -> None:
+        with metrics.timer("writing"):
+            self.file.write(block)
+            if self.fsync == "block":
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        if self.hash_md5:
+            self.hash_md5.update(block)
+        self.position += len(block)
+        if self.checkpoint and self.position >= self.next_checkpoint:
+            # only bytes that were flushed are recorded as done
+            self.file.flush()
+            self.checkpoint(self.position)
+            self.next_checkpoint = self.position + self.checkpoint_interval
+
+    def close(self) -> None:
+        # writes whatever was received, also when the download failed, so it can be resumed.
+        # raises the error of the writer thread, if it had one
+        try:
+            if self.thread:
+                if self.buffer and not self.error:
+                    self.queue.put(bytes(self.buffer))
+                self.buffer = bytearray()
+                self.queue.put(None)
+                self.thread.join()
+            if self.error:
+                raise self.error
+            self.file.flush()
+            if self.fsync != "none":
+                with metrics.timer("writing"):
+                    os.fsync(self.file.fileno())
+        finally:
+            self.file.close()